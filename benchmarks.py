@@ -0,0 +1,334 @@
+"""
+Benchmarks for the Flask-Misaka render paths.
+
+Run them with::
+
+    python benchmarks.py --output results.json
+
+compare two runs with::
+
+    python benchmarks.py --compare before.json after.json
+
+and compare the output and throughput of the Markdown engines which are
+installed with::
+
+    python benchmarks.py --engines
+
+The corpus is generated from a fixed seed, so runs on the same machine are
+comparable.
+"""
+from __future__ import print_function, unicode_literals
+
+import argparse
+import json
+import platform
+import random
+import re
+import sys
+import time
+import tracemalloc
+import warnings
+
+import misaka
+from flask import Flask, render_template_string
+from markupsafe import Markup
+
+import flask_misaka
+from flask_misaka import ENGINES, Misaka, make_profile, markdown
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod "
+         "tempor incididunt ut labore et dolore magna aliqua it's \"quoted\" -- "
+         "*emphasis* **strong** `code` [link](http://example.com) ~~struck~~").split()
+
+
+def sentence(rng, length):
+    return ' '.join(rng.choice(WORDS) for _ in range(length)).capitalize() + '.'
+
+
+def paragraph(rng):
+    return ' '.join(sentence(rng, rng.randint(5, 15)) for _ in range(rng.randint(2, 6)))
+
+
+def comment(rng):
+    return sentence(rng, rng.randint(5, 30))
+
+
+def long_doc(rng):
+    parts = []
+    for section in range(rng.randint(5, 10)):
+        parts.append('## Section %d' % section)
+        parts.extend(paragraph(rng) for _ in range(rng.randint(3, 8)))
+        parts.append('\n'.join('- ' + sentence(rng, 6) for _ in range(5)))
+    return '\n\n'.join(parts)
+
+
+def table_doc(rng):
+    rows = ['| Name | Value | Notes |', '|:-----|------:|:-----:|']
+    rows.extend('| %s | %d | %s |' % (rng.choice(WORDS), rng.randint(0, 1000),
+                                       sentence(rng, 4)) for _ in range(40))
+    return paragraph(rng) + '\n\n' + '\n'.join(rows)
+
+
+def code_doc(rng):
+    parts = []
+    for _ in range(10):
+        parts.append(paragraph(rng))
+        lines = ['def f%d(x):' % rng.randint(0, 99)]
+        lines.extend('    x = x + %d  # %s' % (i, rng.choice(WORDS)) for i in range(10))
+        lines.append('    return x')
+        parts.append('```python\n%s\n```' % '\n'.join(lines))
+    return '\n\n'.join(parts)
+
+
+def footnote_doc(rng):
+    parts = []
+    notes = []
+    for i in range(20):
+        parts.append(paragraph(rng) + '[^%d]' % i)
+        notes.append('[^%d]: %s' % (i, sentence(rng, 8)))
+    return '\n\n'.join(parts + notes)
+
+
+CORPORA = {
+    'comments': (comment, 200),
+    'long_docs': (long_doc, 10),
+    'tables': (table_doc, 20),
+    'code': (code_doc, 20),
+    'footnotes': (footnote_doc, 20),
+}
+
+OPTIONS = dict(tables=True, fenced_code=True, footnotes=True, strikethrough=True)
+
+
+def make_corpus(name, seed=0):
+    """
+    Returns the list of documents of the named corpus.
+    """
+    generate, size = CORPORA[name]
+    rng = random.Random('%s-%d' % (name, seed))
+    return [generate(rng) for _ in range(size)]
+
+
+class CustomRenderer(misaka.HtmlRenderer):
+    def image(self, link, title, alt_text):
+        return '<figure><img src="%s" alt="%s"></figure>' % (link, alt_text)
+
+
+ELEMENTS = {'table': {'class': 'table'}, 'link': {'rel': 'nofollow'}}
+
+
+class HandWrittenRenderer(misaka.HtmlRenderer):
+    """
+    The renderer one would write by hand for :data:`ELEMENTS`.
+    """
+    def table(self, content):
+        return '<table class="table">\n' + content + '</table>\n'
+
+    def link(self, content, link, title):
+        html = '<a href="' + misaka.escape_html(link) + '"'
+        if title:
+            html += ' title="' + misaka.escape_html(title) + '"'
+        return html + ' rel="nofollow">' + content + '</a>'
+
+
+def scenarios():
+    """
+    Returns the benchmarked render paths, as a dictionary of functions taking
+    a Markdown text.
+    """
+    app = Flask(__name__)
+    ext = Misaka(app, **OPTIONS)
+    custom = Misaka(None, CustomRenderer(), **OPTIONS)
+    smarty = Misaka(smartypants=True, **OPTIONS)
+    elements = Misaka(elements=ELEMENTS, **OPTIONS)
+    hand_written = Misaka(None, HandWrittenRenderer, **OPTIONS)
+
+    def two_pass_smartypants(text):
+        # the way SmartyPants used to be applied, for comparison
+        profile = smarty.profile
+        html = misaka.html(text, extensions=profile.ext, render_flags=profile.rndr)
+        return Markup(misaka.smartypants(html))
+
+    def template(text):
+        with app.app_context():
+            return render_template_string('{{ text|markdown }}', text=text)
+
+    return {
+        'markdown': lambda text: markdown(text, **OPTIONS),
+        'render': ext.render,
+        'render_override': lambda text: ext.render(text, autolink=True),
+        'smartypants': smarty.render,
+        'smartypants_two_pass': two_pass_smartypants,
+        'template_filter': template,
+        'custom_renderer': custom.render,
+        'element_overrides': elements.render,
+        'element_hand_written': hand_written.render,
+    }
+
+
+def percentile(timings, percent):
+    index = min(len(timings) - 1, int(round(len(timings) * percent / 100.0)))
+    return timings[index]
+
+
+def peak_memory(func, corpus):
+    """
+    Returns the largest amount of memory allocated by Python while rendering
+    any document of the corpus, in bytes.
+    """
+    peak = 0
+    tracemalloc.start()
+    try:
+        for text in corpus:
+            tracemalloc.clear_traces()
+            baseline = tracemalloc.get_traced_memory()[0]
+            func(text)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+
+def measure(func, corpus, min_time):
+    """
+    Renders the corpus repeatedly for at least ``min_time`` seconds, and
+    returns throughput, latency and peak memory figures.
+    """
+    for text in corpus:
+        func(text)
+    peak = peak_memory(func, corpus)
+    timings = []
+    size = sum(len(text.encode('utf-8')) for text in corpus)
+    rounds = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < min_time or not rounds:
+        for text in corpus:
+            start = time.perf_counter()
+            func(text)
+            timings.append(time.perf_counter() - start)
+        rounds += 1
+    total = sum(timings)
+    timings.sort()
+    return {
+        'calls': len(timings),
+        'docs_per_sec': len(timings) / total,
+        'mb_per_sec': size * rounds / total / 1e6,
+        'p50_us': percentile(timings, 50) * 1e6,
+        'p90_us': percentile(timings, 90) * 1e6,
+        'p99_us': percentile(timings, 99) * 1e6,
+        'peak_kb': peak / 1024.0,
+    }
+
+
+def run(selected_scenarios, selected_corpora, min_time, seed):
+    paths = scenarios()
+    results = {}
+    for corpus_name in selected_corpora:
+        corpus = make_corpus(corpus_name, seed)
+        for name in selected_scenarios:
+            result = measure(paths[name], corpus, min_time)
+            results['%s/%s' % (name, corpus_name)] = result
+            print('%-36s %10.0f docs/s %8.2f MB/s  p50 %8.1fus  p99 %8.1fus  '
+                  'peak %8.1fKB' % ('%s/%s' % (name, corpus_name), result['docs_per_sec'],
+                                    result['mb_per_sec'], result['p50_us'],
+                                    result['p99_us'], result['peak_kb']))
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'misaka': misaka.__version__ if hasattr(misaka, '__version__') else None,
+            'flask_misaka': flask_misaka.__version__,
+            'seed': seed,
+            'min_time': min_time,
+        },
+        'results': results,
+    }
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)['results']
+    with open(after_path) as f:
+        after = json.load(f)['results']
+    for name in sorted(set(before) & set(after)):
+        ratio = after[name]['docs_per_sec'] / before[name]['docs_per_sec']
+        print('%-36s %8.2fx throughput  p99 %8.1fus -> %8.1fus' % (
+            name, ratio, before[name]['p99_us'], after[name]['p99_us']))
+
+
+def normalize(html):
+    """
+    Normalizes the whitespace of rendered HTML, which engines don't agree on.
+    """
+    return re.sub(r'\s+', ' ', re.sub(r'>\s+<', '><', html)).strip()
+
+
+def compare_engines(selected_corpora, min_time, seed):
+    """
+    Renders the corpora with each installed engine, counts the documents
+    whose output differs from the misaka engine's, and measures throughput.
+    Returns the name of the fastest engine matching the misaka engine on
+    every document.
+    """
+    profile = make_profile(**OPTIONS)
+    totals = {}
+    for name, engine in ENGINES.items():
+        if not engine.available():
+            print('%-12s not installed' % name)
+            continue
+        unsupported = engine.unsupported(profile)
+        if unsupported:
+            print('%-12s ignores %s' % (name, ', '.join(unsupported)))
+
+        def render(text, name=name):
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                return markdown(text, engine=name, **OPTIONS)
+
+        for corpus_name in selected_corpora:
+            corpus = make_corpus(corpus_name, seed)
+            differences = sum(normalize(render(text)) != normalize(markdown(text, **OPTIONS))
+                              for text in corpus)
+            result = measure(render, corpus, min_time)
+            total = totals.setdefault(name, {'differences': len(unsupported), 'time': 0.0})
+            total['differences'] += differences
+            total['time'] += result['calls'] / result['docs_per_sec']
+            print('%-12s %-10s %4d/%-4d differ %10.0f docs/s  p99 %8.1fus' % (
+                name, corpus_name, differences, len(corpus), result['docs_per_sec'],
+                result['p99_us']))
+    matching = [name for name, total in totals.items() if not total['differences']]
+    return min(matching, key=lambda name: totals[name]['time'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=sorted(scenarios()),
+                        help='render path to benchmark (default: all)')
+    parser.add_argument('--corpus', action='append', choices=sorted(CORPORA),
+                        help='corpus to render (default: all)')
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help='minimum seconds to spend on each benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help='compare two JSON result files instead of running')
+    parser.add_argument('--engines', action='store_true',
+                        help='compare the output and throughput of the Markdown engines')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.engines:
+        fastest = compare_engines(args.corpus or sorted(CORPORA), args.min_time, args.seed)
+        print('Fastest engine with the same output: %s' % fastest)
+        return
+    results = run(args.scenario or sorted(scenarios()), args.corpus or sorted(CORPORA),
+                  args.min_time, args.seed)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
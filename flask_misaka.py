@@ -2,9 +2,42 @@ from __future__ import absolute_import, unicode_literals
 
 __version__ = '1.0.1'
 
+import binascii
+import bisect
+import fnmatch
+import functools
+import hashlib
+import io
+import json
+import math
+import multiprocessing
+import os
+import re
+import socket
+import sys
+import tempfile
+import threading
+import time
+import warnings
+from collections import OrderedDict, namedtuple
+
 import misaka
 from markupsafe import Markup
-from copy import copy
+try:
+    from blinker import Namespace
+except ImportError:
+    Namespace = None
+try:
+    from jinja2 import nodes
+    from jinja2.exceptions import TemplateRuntimeError
+    from jinja2.ext import Extension
+    from jinja2.lexer import Token
+except ImportError:
+    Extension = object
+try:
+    from misaka._hoedown import ffi as _ffi, lib as _lib
+except ImportError:
+    _lib = None
 
 # import constants for compatibility
 from misaka import (EXT_AUTOLINK, EXT_FENCED_CODE,  # pyflakes.ignore
@@ -63,62 +96,3079 @@ def make_flags(**options):
     return ext, rndr
 
 
-def markdown(text, renderer=None, **options):
+class Heading(namedtuple('Heading', 'level text slug')):
     """
-    Parses the provided Markdown-formatted text into valid HTML, and returns
-    it as a :class:`flask.Markup` instance.
+    A heading found by the ``toc`` feature: its level, its text without any
+    markup, and the slug used as its ``id``.
+    """
+    __slots__ = ()
 
-    :param text: Markdown-formatted text to be rendered into HTML
-    :param renderer: A custom misaka renderer to be used instead of the default one
-    :param options: Additional options for customizing the default renderer
-    :return: A :class:`flask.Markup` instance representing the rendered text
+
+_HREF_UNSAFE_RE = re.compile(r"[^-!#$%()*+,./0-9:;=?@A-Z_a-z~]")
+_HREF_ENTITIES = {'&': '&amp;', "'": '&#x27;'}
+
+
+def _escape_href_char(match):
+    char = match.group()
+    if char in _HREF_ENTITIES:
+        return _HREF_ENTITIES[char]
+    return ''.join('%%%02X' % byte for byte in bytearray(char.encode('utf-8')))
+
+
+def _escape_href(url):
+    return _HREF_UNSAFE_RE.sub(_escape_href_char, url)
+
+
+# The HTML Hoedown renders for the elements whose callbacks are overridden
+# by renderer features. Hoedown also separates block elements with a newline,
+# which Python callbacks can't do.
+
+def _html_link(content, link, title):
+    title = ' title="%s"' % misaka.escape_html(title) if title else ''
+    return '<a href="%s"%s>%s</a>' % (_escape_href(link), title, content)
+
+
+def _html_autolink(link, is_email):
+    text = link[7:] if link.startswith('mailto:') else link
+    return '<a href="%s%s">%s</a>' % ('mailto:' if is_email else '', _escape_href(link),
+                                      misaka.escape_html(text))
+
+
+def _html_image(link, title, alt, xhtml):
+    if not link:
+        return ''
+    title = '" title="%s' % misaka.escape_html(title) if title else ''
+    return '<img src="%s" alt="%s%s%s>' % (_escape_href(link), misaka.escape_html(alt),
+                                           title, '"/' if xhtml else '"')
+
+
+def _html_paragraph(content, flags, suffix='', attributes=''):
+    content = content.lstrip(' \t\n\r\f\v')
+    if flags & HTML_HARD_WRAP:
+        if content.endswith('\n'):
+            content = content[:-1]
+        content = ('<br/>\n' if flags & HTML_USE_XHTML else '<br>\n').join(content.split('\n'))
+    return '<p%s>%s%s</p>\n' % (attributes, content, suffix)
+
+
+def _html_header(content, level):
+    return '<h%d>%s</h%d>\n' % (level, content, level)
+
+
+def _html_blockquote(content):
+    return '<blockquote>\n%s</blockquote>\n' % content
+
+
+def _html_listitem(content):
+    return '<li>%s</li>\n' % content.rstrip('\n')
+
+
+def _html_table_cell(content, align, is_header):
+    tag = 'th' if is_header else 'td'
+    align = ' style="text-align: %s"' % align if align else ''
+    return '<%s%s>%s</%s>\n' % (tag, align, content, tag)
+
+
+def _html_blockcode(text, lang):
+    if lang:
+        return '<pre><code class="language-%s">%s</code></pre>\n' % (
+            misaka.escape_html(lang), misaka.escape_html(text))
+    return '<pre><code>%s</code></pre>\n' % misaka.escape_html(text)
+
+
+class RendererFeature(object):
+    """
+    The base class of the mixins implementing renderer features, which are
+    enabled by boolean options named after them in :data:`FEATURES`. For a
+    given set of features, the mixins are combined with the renderer class,
+    so only the callbacks they define go through Python.
+
+    Renderers are reused, so :meth:`reset` is called before rendering each
+    document, and :meth:`collect` afterwards to gather the data the features
+    collected, which ends up as attributes of the :class:`RenderResult`.
+    Subclasses must call the implementation of their parent classes.
+    """
+    def reset(self):
+        pass
+
+    def collect(self):
+        return {}
+
+    @classmethod
+    def load(cls, data):
+        """
+        Restores the collected data after it was stored as JSON in a cache.
+        """
+
+
+_OPENING_TAG_RE = re.compile(r'^(\s*<[a-zA-Z][a-zA-Z0-9]*)')
+
+
+class TocFeature(RendererFeature):
+    """
+    The ``toc`` feature: gives headings an ``id`` derived from their text,
+    and collects them as :class:`Heading` tuples in ``headings``.
+    """
+    def reset(self):
+        super(TocFeature, self).reset()
+        self.headings = []
+        self._slugs = set()
+
+    def collect(self):
+        data = super(TocFeature, self).collect()
+        data['headings'] = self.headings
+        return data
+
+    @classmethod
+    def load(cls, data):
+        super(TocFeature, cls).load(data)
+        data['headings'] = [Heading(*heading) for heading in data.get('headings', ())]
+
+    def header(self, content, level):
+        text = _unescape(_TAG_RE.sub('', content)).strip()
+        base = _SLUG_RE.sub('-', text.lower()).strip('-') or 'section'
+        slug = base
+        counter = 1
+        while slug in self._slugs:
+            counter += 1
+            slug = '%s-%d' % (base, counter)
+        self._slugs.add(slug)
+        self.headings.append(Heading(level, text, slug))
+        parent = getattr(super(TocFeature, self), 'header', None)
+        if parent is not None:
+            # the id goes on the first tag of the parent's markup
+            return _OPENING_TAG_RE.sub(r'\1 id="%s"' % slug, parent(content, level), 1)
+        return '<h%d id="%s">%s</h%d>\n' % (level, slug, content, level)
+
+
+_WORD_RE = re.compile(r'\w', re.UNICODE)
+
+
+class CollectFeature(RendererFeature):
+    """
+    The ``collect`` feature: collects the URLs of links (``links``) and
+    images (``images``), the languages of fenced code blocks
+    (``code_languages``), the number of footnote references
+    (``footnotes``) and the number of words of text (``word_count``).
+    """
+    def reset(self):
+        super(CollectFeature, self).reset()
+        self.links = []
+        self.images = []
+        self.code_languages = []
+        self.footnotes = 0
+        self.word_count = 0
+        self._in_word = False
+
+    def collect(self):
+        data = super(CollectFeature, self).collect()
+        data.update(links=self.links, images=self.images,
+                    code_languages=self.code_languages,
+                    footnotes=self.footnotes, word_count=self.word_count)
+        return data
+
+    def link(self, content, link, title):
+        self.links.append(link)
+        parent = getattr(super(CollectFeature, self), 'link', None)
+        if parent is not None:
+            return parent(content, link, title)
+        return _html_link(content, link, title)
+
+    def autolink(self, link, is_email):
+        self.links.append(('mailto:' if is_email and not link.startswith('mailto:') else '')
+                          + link)
+        parent = getattr(super(CollectFeature, self), 'autolink', None)
+        if parent is not None:
+            return parent(link, is_email)
+        return _html_autolink(link, is_email)
+
+    def image(self, link, title, alt):
+        if link:
+            self.images.append(link)
+        parent = getattr(super(CollectFeature, self), 'image', None)
+        if parent is not None:
+            return parent(link, title, alt)
+        return _html_image(link, title, alt, self.render_flags & HTML_USE_XHTML)
+
+    def blockcode(self, text, lang):
+        if lang and lang not in self.code_languages:
+            self.code_languages.append(lang)
+        parent = getattr(super(CollectFeature, self), 'blockcode', None)
+        if parent is not None:
+            return parent(text, lang)
+        return _html_blockcode(text, lang)
+
+    def footnote_ref(self, num):
+        self.footnotes += 1
+        parent = getattr(super(CollectFeature, self), 'footnote_ref', None)
+        if parent is not None:
+            return parent(num)
+        return '<sup id="fnref%d"><a href="#fn%d" rel="footnote">%d</a></sup>' % (num, num, num)
+
+    def normal_text(self, text):
+        # Hoedown hands text over in pieces, splitting words at the characters
+        # that may start an autolink (``www.``, ``@``...)
+        words = sum(1 for word in text.split() if _WORD_RE.search(word))
+        if words and self._in_word and text[0].isalnum():
+            words -= 1
+        self.word_count += words
+        self._in_word = bool(text) and text[-1].isalnum()
+        parent = getattr(super(CollectFeature, self), 'normal_text', None)
+        if parent is not None:
+            return parent(text)
+        return misaka.escape_html(text)
+
+
+HIGHLIGHT_CACHE_SIZE = 1024
+
+_highlight_cache = OrderedDict()
+_highlight_lock = threading.Lock()
+_lexers = {}
+_pygments = None
+
+
+def _import_pygments():
+    global _pygments
+    if _pygments is None:
+        try:
+            from pygments import highlight
+            from pygments.formatters import HtmlFormatter
+            from pygments.lexers import get_lexer_by_name
+            from pygments.util import ClassNotFound
+        except ImportError:
+            warnings.warn('Pygments is needed to highlight code blocks', stacklevel=4)
+            _pygments = False
+        else:
+            _pygments = (highlight, HtmlFormatter, get_lexer_by_name, ClassNotFound)
+    return _pygments
+
+
+def _get_lexer(lang):
+    try:
+        return _lexers[lang]
+    except KeyError:
+        pass
+    _, _, get_lexer_by_name, ClassNotFound = _pygments
+    try:
+        lexer = get_lexer_by_name(lang)
+    except ClassNotFound:
+        return None
+    # only names Pygments knows are kept, so the fence info strings of
+    # user input can't grow the dictionary
+    _lexers[lang] = lexer
+    return lexer
+
+
+class HighlightFeature(RendererFeature):
+    """
+    The ``highlight_code`` feature: highlights fenced code blocks whose
+    language is known to `Pygments`_, which is imported on first use. Code
+    blocks without a language, or with an unknown one, are rendered as
+    usual.
+
+    Highlighted blocks are kept in a cache shared by all the renderers, of
+    up to :data:`HIGHLIGHT_CACHE_SIZE` blocks, so a code block which was
+    already highlighted costs a dictionary lookup. By default the tokens get
+    CSS classes, see :meth:`pygments.formatters.HtmlFormatter.get_style_defs`;
+    subclasses may set :attr:`style` to a Pygments style name to get inline
+    styles instead.
+    """
+    #: The Pygments style of inline styles, or ``None`` for CSS classes.
+    style = None
+
+    def blockcode(self, text, lang):
+        html = None
+        if lang and _import_pygments():
+            html = self._highlight(text, lang)
+        if html is not None:
+            return html
+        parent = getattr(super(HighlightFeature, self), 'blockcode', None)
+        if parent is not None:
+            return parent(text, lang)
+        return _html_blockcode(text, lang)
+
+    def _highlight(self, text, lang):
+        key = (lang, _digest(text), self.style)
+        with _highlight_lock:
+            html = _highlight_cache.pop(key, None)
+            if html is not None:
+                _highlight_cache[key] = html
+                return html
+        lexer = _get_lexer(lang)
+        if lexer is None:
+            return None
+        highlight, HtmlFormatter, _, _ = _pygments
+        if self.style is None:
+            formatter = HtmlFormatter()
+        else:
+            formatter = HtmlFormatter(style=self.style, noclasses=True)
+        html = highlight(text, lexer, formatter)
+        with _highlight_lock:
+            _highlight_cache[key] = html
+            while len(_highlight_cache) > HIGHLIGHT_CACHE_SIZE:
+                _highlight_cache.popitem(last=False)
+        return html
+
+
+_HTML_TAG_RE = re.compile(r'^<(/?)([A-Za-z][A-Za-z0-9]*)((?:\s[^>]*?)?)\s*/?>$')
+_HTML_TOKEN_RE = re.compile(r'<!--.*?-->|<[^>]*>', re.DOTALL)
+_ATTRIBUTE_RE = re.compile(r'([^\s"\'>/=]+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'=<>`]+)))?')
+_SCHEME_RE = re.compile(r'^([A-Za-z][A-Za-z0-9+.-]*):')
+_IGNORED_URL_CHARS_RE = re.compile(r'[\x00-\x20]+')
+
+_BARE_AMP_RE = re.compile(r'&(?!#?\w+;)')
+_VOID_TAGS = frozenset(['br', 'hr', 'img', 'wbr'])
+
+
+class SanitizeFeature(RendererFeature):
+    """
+    The ``sanitize`` feature: only lets through the HTML tags, attributes
+    and URL schemes of its allowlists, while the document is rendered.
+    Other tags are escaped, other attributes dropped, and links or images
+    with another scheme are rendered as text. HTML comments are dropped,
+    and inline tags left open are closed at the end of their paragraph,
+    heading, list item, table cell or block quote.
+
+    The allowlists can be changed by a subclass, registered in
+    :data:`FEATURES` in place of this class.
+    """
+    #: The allowed HTML tags.
+    allowed_tags = frozenset([
+        'a', 'abbr', 'b', 'blockquote', 'br', 'code', 'dd', 'del', 'div', 'dl', 'dt', 'em',
+        'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'hr', 'i', 'img', 'ins', 'kbd', 'li', 'mark',
+        'ol', 'p', 'pre', 'q', 's', 'small', 'span', 'strong', 'sub', 'sup', 'table',
+        'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'u', 'ul',
+    ])
+    #: The allowed attributes, by tag; those of ``'*'`` are allowed on any tag.
+    allowed_attributes = {
+        '*': frozenset(['title']),
+        'a': frozenset(['href']),
+        'img': frozenset(['src', 'alt', 'width', 'height']),
+        'td': frozenset(['align']),
+        'th': frozenset(['align']),
+    }
+    #: The attributes holding a URL, whose scheme is checked.
+    url_attributes = frozenset(['href', 'src'])
+    #: The allowed URL schemes. URLs without a scheme are always allowed.
+    allowed_schemes = frozenset(['http', 'https', 'mailto'])
+
+    def reset(self):
+        super(SanitizeFeature, self).reset()
+        self._open_tags = []
+
+    def url_allowed(self, url):
+        """
+        Whether the URL, as a browser would read it, has an allowed scheme.
+        """
+        match = _SCHEME_RE.match(_IGNORED_URL_CHARS_RE.sub('', _unescape(url)))
+        return match is None or match.group(1).lower() in self.allowed_schemes
+
+    def _sanitize_tag(self, tag, open_tags):
+        # returns the cleaned tag, or None if it isn't allowed
+        match = _HTML_TAG_RE.match(tag)
+        if match is None:
+            return None
+        closing, name, attributes = match.groups()
+        name = name.lower()
+        if name not in self.allowed_tags:
+            return None
+        if closing:
+            if name not in open_tags:
+                return None
+            html = ''
+            while open_tags:
+                last = open_tags.pop()
+                html += '</%s>' % last
+                if last == name:
+                    return html
+        allowed = self.allowed_attributes.get(name, frozenset()) | \
+            self.allowed_attributes.get('*', frozenset())
+        html = '<' + name
+        for match in _ATTRIBUTE_RE.finditer(attributes):
+            attribute = match.group(1).lower()
+            value = next((value for value in match.groups()[1:] if value is not None), None)
+            if attribute not in allowed:
+                continue
+            if value is None:
+                html += ' ' + attribute
+                continue
+            if attribute in self.url_attributes and not self.url_allowed(value):
+                continue
+            html += ' %s="%s"' % (attribute, misaka.escape_html(_unescape(value)))
+        if name in _VOID_TAGS:
+            return html + ('/>' if self.render_flags & HTML_USE_XHTML else '>')
+        open_tags.append(name)
+        return html + '>'
+
+    @staticmethod
+    def _sanitize_text(text):
+        return _BARE_AMP_RE.sub('&amp;', text).replace('<', '&lt;')
+
+    def _close_tags(self):
+        html = ''.join('</%s>' % name for name in reversed(self._open_tags))
+        del self._open_tags[:]
+        return html
+
+    def paragraph(self, content):
+        # inline tags left open are closed with their paragraph
+        parent = getattr(super(SanitizeFeature, self), 'paragraph', None)
+        if parent is not None:
+            return parent(content.lstrip(' \t\n\r\f\v') + self._close_tags())
+        return _html_paragraph(content, self.render_flags, self._close_tags())
+
+    def header(self, content, level):
+        content += self._close_tags()
+        parent = getattr(super(SanitizeFeature, self), 'header', None)
+        if parent is not None:
+            return parent(content, level)
+        return _html_header(content, level)
+
+    def listitem(self, content, is_ordered, is_block):
+        content = content.rstrip('\n') + self._close_tags()
+        parent = getattr(super(SanitizeFeature, self), 'listitem', None)
+        if parent is not None:
+            return parent(content, is_ordered, is_block)
+        return _html_listitem(content)
+
+    def table_cell(self, content, align, is_header):
+        content += self._close_tags()
+        parent = getattr(super(SanitizeFeature, self), 'table_cell', None)
+        if parent is not None:
+            return parent(content, align, is_header)
+        return _html_table_cell(content, align, is_header)
+
+    def blockquote(self, content):
+        content += self._close_tags()
+        parent = getattr(super(SanitizeFeature, self), 'blockquote', None)
+        if parent is not None:
+            return parent(content)
+        return _html_blockquote(content)
+
+    def raw_html(self, text):
+        if text.startswith('<!--'):
+            return '\x00'
+        return self._sanitize_tag(text, self._open_tags) or ''
+
+    def blockhtml(self, text):
+        open_tags = []
+        parts = []
+        position = 0
+        for match in _HTML_TOKEN_RE.finditer(text):
+            parts.append(self._sanitize_text(text[position:match.start()]))
+            tag = match.group()
+            if not tag.startswith('<!--'):
+                parts.append(self._sanitize_tag(tag, open_tags) or misaka.escape_html(tag))
+            position = match.end()
+        parts.append(self._sanitize_text(text[position:]))
+        parts.extend('</%s>' % name for name in reversed(open_tags))
+        return ''.join(parts)
+
+    def doc_footer(self, inline_render):
+        html = self._close_tags()
+        parent = getattr(super(SanitizeFeature, self), 'doc_footer', None)
+        if parent is not None:
+            html += parent(inline_render) or ''
+        return html
+
+    def link(self, content, link, title):
+        if not self.url_allowed(link):
+            return content
+        parent = getattr(super(SanitizeFeature, self), 'link', None)
+        if parent is not None:
+            return parent(content, link, title)
+        return _html_link(content, link, title)
+
+    def autolink(self, link, is_email):
+        if not is_email and not self.url_allowed(link):
+            return misaka.escape_html(link)
+        parent = getattr(super(SanitizeFeature, self), 'autolink', None)
+        if parent is not None:
+            return parent(link, is_email)
+        return _html_autolink(link, is_email)
+
+    def image(self, link, title, alt):
+        if not self.url_allowed(link):
+            return misaka.escape_html(alt) or '\x00'
+        parent = getattr(super(SanitizeFeature, self), 'image', None)
+        if parent is not None:
+            return parent(link, title, alt)
+        return _html_image(link, title, alt, self.render_flags & HTML_USE_XHTML)
+
+
+class MathFeature(RendererFeature):
+    """
+    Leaves a placeholder for each ``math`` span or block, and collects the
+    formulas as ``(tex, display)`` pairs in ``math``, so :class:`Misaka`
+    can hand them to its ``math_renderer`` all at once. It is enabled by
+    :class:`Misaka` rather than by an option.
+
+    Placeholders carry a random token drawn for each document, so the same
+    bytes typed in the text itself are left alone.
+    """
+    def reset(self):
+        super(MathFeature, self).reset()
+        self.formulas = []
+        self.token = binascii.hexlify(os.urandom(8)).decode('ascii')
+
+    def collect(self):
+        data = super(MathFeature, self).collect()
+        data['math'] = (self.token, self.formulas)
+        return data
+
+    def math(self, text, displaymode):
+        self.formulas.append((text, bool(displaymode)))
+        return '\x02%s:%d\x03' % (self.token, len(self.formulas) - 1)
+
+
+def _html_math(text, display):
+    return ('\\[%s\\]' if display else '\\(%s\\)') % misaka.escape_html(text)
+
+
+_MATH_RE = re.compile('\x02([0-9a-f]+):(\\d+)\x03')
+
+
+#: The renderer features, by the name of the option enabling them.
+FEATURES = {
+    'collect': CollectFeature,
+    'highlight_code': HighlightFeature,
+    'sanitize': SanitizeFeature,
+    'toc': TocFeature,
+}
+
+# features enabled by Misaka instances instead of options
+_HOOK_FEATURES = {
+    'math_renderer': MathFeature,
+}
+
+OPTIONS = frozenset(
+    [name for name in ALIAS_EXT] +
+    [name for name in ALIAS_RENDER] +
+    [name[3:] for name in list(ALIAS_EXT) + list(ALIAS_RENDER)
+     if name.startswith('no_')] +
+    ['smartypants', 'engine'] +
+    list(FEATURES)
+)
+
+
+#: How deeply Hoedown parses nested blocks and spans by default.
+MAX_NESTING = 16
+
+
+class Profile(namedtuple('Profile', 'ext rndr smartypants features nesting engine')):
+    """
+    A frozen, hashable set of rendering options, resolved once by
+    :func:`make_profile` so that rendering doesn't need to look at the
+    option names again. ``features`` is a sorted tuple of the names of the
+    enabled :data:`FEATURES`, ``nesting`` the maximum nesting depth and
+    ``engine`` the name of the :data:`ENGINES` entry which renders.
+    """
+    __slots__ = ()
+
+    def __new__(cls, ext, rndr, smartypants, features=(), nesting=MAX_NESTING,
+                engine='misaka'):
+        return super(Profile, cls).__new__(cls, ext, rndr, smartypants, features, nesting,
+                                           engine)
+
+    @property
+    def fingerprint(self):
+        """
+        A string identifying the options, stable across processes.
+        """
+        fingerprint = '%d:%d:%d' % (self.ext, self.rndr, self.smartypants)
+        if self.features:
+            fingerprint += ':' + ','.join(self.features)
+        if self.nesting != MAX_NESTING:
+            fingerprint += ':n%d' % self.nesting
+        if self.engine != 'misaka':
+            fingerprint += ':' + self.engine
+        return fingerprint
+
+
+def _choose_engine(names, profile):
+    unknown = [name for name in names if name not in ENGINES]
+    if unknown:
+        raise ValueError('Unknown Markdown engine: %s' % ', '.join(unknown))
+    available = [name for name in names if ENGINES[name].available()]
+    if not available:
+        raise ValueError('None of these Markdown engines is installed: %s' % ', '.join(names))
+    for name in available:
+        if not ENGINES[name].unsupported(profile) and (name == 'misaka' or not profile.features):
+            return name
+    return available[0]
+
+
+def make_profile(**options):
+    """
+    Resolves the given options into a :class:`Profile`. Unknown option names
+    are ignored, like they are by :func:`markdown`.
+
+    The ``engine`` option names the :data:`ENGINES` entry to render with,
+    ``'misaka'`` by default. Given a list of names in order of preference,
+    the first installed engine which supports all the other options is
+    used, or else the first installed one. An engine which doesn't support
+    some of the options ignores them, with a warning.
     """
     ext, rndr = make_flags(**options)
-    if renderer:
-        md = misaka.Markdown(renderer,ext)
-        result = md(text)
+    features = tuple(sorted(name for name in FEATURES if options.get(name)))
+    profile = Profile(ext, rndr, bool(options.get('smartypants')), features)
+    engine = options.get('engine') or 'misaka'
+    if isinstance(engine, (list, tuple)):
+        engine = _choose_engine(engine, profile)
+    elif engine not in ENGINES:
+        raise ValueError('Unknown Markdown engine: %s' % engine)
+    if engine != 'misaka':
+        if features:
+            raise ValueError('Renderer features need the misaka engine')
+        unsupported = ENGINES[engine].unsupported(profile)
+        if unsupported:
+            warnings.warn('The %s engine ignores these options: %s'
+                          % (engine, ', '.join(unsupported)), stacklevel=3)
+        profile = profile._replace(engine=engine)
+    return profile
+
+
+class RenderResult(Markup):
+    """
+    The :class:`flask.Markup` returned when renderer features collected
+    data while rendering, like the headings found by the ``toc`` feature.
+    The data is available as attributes, and in the ``data`` dictionary.
+    """
+    def __new__(cls, html, data=None):
+        self = super(RenderResult, cls).__new__(cls, html)
+        self.data = data or {}
+        return self
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['data'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+_feature_classes = {}
+
+
+def _make_renderer(factory, profile):
+    if not profile.features:
+        return factory(profile.rndr) if getattr(factory, '_profile_flags', False) else factory()
+    if factory is not None and not isinstance(factory, type):
+        raise ValueError('Renderer features need the default renderer or a renderer class')
+    key = (factory, profile.features)
+    cls = _feature_classes.get(key)
+    if cls is None:
+        bases = tuple(FEATURES.get(name) or _HOOK_FEATURES[name] for name in profile.features)
+        bases += (factory or misaka.HtmlRenderer,)
+        cls = _feature_classes[key] = type(str('FeatureRenderer'), bases, {})
+    if factory is None or getattr(factory, '_profile_flags', False):
+        renderer = cls(profile.rndr)
     else:
-        result = misaka.html(text, extensions=ext, render_flags=rndr)
-    if options.get("smartypants"):
-        result = misaka.smartypants(result)
-    return Markup(result)
+        renderer = cls()
+    renderer.render_flags = profile.rndr
+    return renderer
 
 
-class Misaka(object):
-    def __init__(self, app=None, renderer=None, **defaults):
-        """
-        Set the default options for the :meth:`render` method. If you want
-        the ``markdown`` template filter to use options, set them here.
+def _format_attributes(attributes):
+    return ''.join(' %s="%s"' % (name, misaka.escape_html(_text_type(value)))
+                   for name, value in sorted(attributes.items()))
 
-        A custom misaka renderer can be specified to be used instead of the
-        default one.
+
+# Each element is built from its pre-formatted attributes into a callback
+# which renders it like Hoedown does, plus the attributes.
+def _table_element(attributes):
+    html = '<table%s>\n%%s</table>\n' % attributes
+
+    def table(self, content):
+        return html % content
+    return table
+
+
+def _link_element(attributes):
+    def link(self, content, link, title):
+        title = ' title="%s"' % misaka.escape_html(title) if title else ''
+        return '<a href="%s"%s%s>%s</a>' % (_escape_href(link), title, attributes, content)
+    return link
+
+
+def _autolink_element(attributes):
+    def autolink(self, link, is_email):
+        text = link[7:] if link.startswith('mailto:') else link
+        return '<a href="%s%s"%s>%s</a>' % ('mailto:' if is_email else '', _escape_href(link),
+                                            attributes, misaka.escape_html(text))
+    return autolink
+
+
+def _image_element(attributes):
+    def image(self, link, title, alt):
+        if not link:
+            return ''
+        title = ' title="%s"' % misaka.escape_html(title) if title else ''
+        return '<img src="%s" alt="%s"%s%s%s' % (
+            _escape_href(link), misaka.escape_html(alt), title, attributes,
+            '/>' if self.render_flags & HTML_USE_XHTML else '>')
+    return image
+
+
+def _header_element(attributes):
+    def header(self, content, level):
+        return '<h%d%s>%s</h%d>\n' % (level, attributes, content, level)
+    return header
+
+
+def _blockquote_element(attributes):
+    html = '<blockquote%s>\n%%s</blockquote>\n' % attributes
+
+    def blockquote(self, content):
+        return html % content
+    return blockquote
+
+
+def _blockcode_element(attributes):
+    def blockcode(self, text, lang):
+        if lang:
+            return '<pre%s><code class="language-%s">%s</code></pre>\n' % (
+                attributes, misaka.escape_html(lang), misaka.escape_html(text))
+        return '<pre%s><code>%s</code></pre>\n' % (attributes, misaka.escape_html(text))
+    return blockcode
+
+
+def _codespan_element(attributes):
+    html = '<code%s>%%s</code>' % attributes
+
+    def codespan(self, text):
+        return html % misaka.escape_html(text)
+    return codespan
+
+
+def _list_element(attributes):
+    ordered = '<ol%s>\n%%s</ol>\n' % attributes
+    unordered = '<ul%s>\n%%s</ul>\n' % attributes
+
+    def list(self, content, is_ordered, is_block):
+        return (ordered if is_ordered else unordered) % content
+    return list
+
+
+def _paragraph_element(attributes):
+    def paragraph(self, content):
+        return _html_paragraph(content, self.render_flags, attributes=attributes)
+    return paragraph
+
+
+def _hrule_element(attributes):
+    def hrule(self):
+        return '<hr%s%s\n' % (attributes, '/>' if self.render_flags & HTML_USE_XHTML else '>')
+    return hrule
+
+
+#: The elements which can be overridden with :func:`element_renderer`, with
+#: the fields of their templates.
+ELEMENTS = {
+    'autolink': ('href', 'text'),
+    'blockcode': ('text', 'lang'),
+    'blockquote': ('content',),
+    'codespan': ('text',),
+    'header': ('content', 'level'),
+    'hrule': (),
+    'image': ('src', 'alt', 'title'),
+    'link': ('content', 'href', 'title'),
+    'list': ('content', 'tag'),
+    'paragraph': ('content',),
+    'table': ('content',),
+}
+
+_ELEMENT_BUILDERS = {
+    'autolink': _autolink_element,
+    'blockcode': _blockcode_element,
+    'blockquote': _blockquote_element,
+    'codespan': _codespan_element,
+    'header': _header_element,
+    'hrule': _hrule_element,
+    'image': _image_element,
+    'link': _link_element,
+    'list': _list_element,
+    'paragraph': _paragraph_element,
+    'table': _table_element,
+}
+
+_ELEMENT_FIELDS = {
+    'autolink': lambda link, is_email: dict(
+        href=('mailto:' if is_email else '') + _escape_href(link),
+        text=misaka.escape_html(link[7:] if link.startswith('mailto:') else link)),
+    'blockcode': lambda text, lang: dict(text=misaka.escape_html(text),
+                                         lang=misaka.escape_html(lang)),
+    'blockquote': lambda content: dict(content=content),
+    'codespan': lambda text: dict(text=misaka.escape_html(text)),
+    'header': lambda content, level: dict(content=content, level=level),
+    'hrule': lambda: {},
+    'image': lambda link, title, alt: dict(src=_escape_href(link), alt=misaka.escape_html(alt),
+                                           title=misaka.escape_html(title)),
+    'link': lambda content, link, title: dict(content=content, href=_escape_href(link),
+                                              title=misaka.escape_html(title)),
+    'list': lambda content, is_ordered, is_block: dict(content=content,
+                                                       tag='ol' if is_ordered else 'ul'),
+    'paragraph': lambda content: dict(content=content.lstrip(' \t\n\r\f\v')),
+    'table': lambda content: dict(content=content),
+}
+
+
+def _template_element(name, template):
+    fields = _ELEMENT_FIELDS[name]
+
+    def element(self, *args):
+        return template.format(**fields(*args))
+    element.__name__ = str(name)
+    return element
+
+
+def element_renderer(elements, base=None):
+    """
+    Returns a renderer class which changes how some elements are rendered,
+    and leaves the rendering of the others to Hoedown, so they cost nothing.
+    ``elements`` maps the names of :data:`ELEMENTS` either to a dictionary
+    of attributes to add to the element, or to a template, formatted with
+    :meth:`str.format` and the fields of the element, which are escaped
+    already:
+
+    .. code-block:: python
+
+      Renderer = element_renderer({
+          'table': {'class': 'table'},
+          'link': {'rel': 'nofollow'},
+          'hrule': '<hr class="separator">\\n',
+          'header': '<h{level} class="title">{content}</h{level}>\\n',
+      })
+
+    Both are turned into a callback doing a single string formatting
+    operation, as cheap as a Python callback can be. Unlike a renderer
+    class passed to :class:`Misaka`, the returned class uses the rendering
+    options, like ``xhtml``.
+
+    :param elements: the overrides, by element name
+    :param base: the :class:`misaka.HtmlRenderer` subclass to extend
+    :return: a :class:`misaka.HtmlRenderer` subclass
+    """
+    base = base or misaka.HtmlRenderer
+    unknown = set(elements) - set(ELEMENTS)
+    if unknown:
+        raise ValueError('Unknown elements: %s' % ', '.join(sorted(unknown)))
+    namespace = {}
+    for name, spec in elements.items():
+        if isinstance(spec, dict):
+            namespace[name] = _ELEMENT_BUILDERS[name](_format_attributes(spec))
+        else:
+            namespace[name] = _template_element(name, spec)
+
+    def __init__(self, flags=0, nesting_level=0):
+        base.__init__(self, flags, nesting_level)
+        self.render_flags = flags
+    namespace['__init__'] = __init__
+    namespace['_profile_flags'] = True
+    # the name identifies the overrides in cache keys and fingerprints
+    digest = _digest(json.dumps([_renderer_name(base), elements], sort_keys=True, default=repr))
+    return type(str('ElementRenderer_%s' % digest[:12]), (base,), namespace)
+
+
+def _render_native(text, profile, md=None):
+    """
+    Renders with Hoedown directly, running SmartyPants over the output
+    buffer before it is decoded, instead of decoding the HTML, encoding it
+    again for :func:`misaka.smartypants` and decoding its result. Unlike
+    :class:`misaka.Markdown`, it also honours the nesting depth of the
+    profile.
+    """
+    ib = _lib.hoedown_buffer_new(1024)
+    ob = _lib.hoedown_buffer_new(64)
+    sb = None
+    renderer = None
+    try:
+        _lib.hoedown_buffer_puts(ib, text.encode('utf-8'))
+        if md is not None:
+            document = _lib.hoedown_document_new(md.renderer.renderer, md.extensions,
+                                                 profile.nesting)
+        else:
+            renderer = _lib.hoedown_html_renderer_new(profile.rndr, 0)
+            document = _lib.hoedown_document_new(renderer, profile.ext, profile.nesting)
+        _lib.hoedown_document_render(document, ob, ib.data, ib.size)
+        _lib.hoedown_document_free(document)
+        if profile.smartypants:
+            sb = _lib.hoedown_buffer_new(64)
+            _lib.hoedown_html_smartypants(sb, ob.data, ob.size)
+            ob, sb = sb, ob
+        if ob.size == 0:
+            return ''
+        return _ffi.string(ob.data, ob.size).decode('utf-8')
+    finally:
+        if renderer is not None:
+            _lib.hoedown_html_renderer_free(renderer)
+        _lib.hoedown_buffer_free(ib)
+        _lib.hoedown_buffer_free(ob)
+        if sb is not None:
+            _lib.hoedown_buffer_free(sb)
+
+
+class Engine(object):
+    """
+    The base class of the Markdown engines of :data:`ENGINES`, which render
+    a text for a :class:`Profile`. SmartyPants is applied to the output of
+    any engine.
+
+    :attr:`options` maps the names of the options of :data:`ALIAS_EXT` and
+    :data:`ALIAS_RENDER` which the engine supports to what the engine calls
+    them; other options are ignored.
+    """
+    #: The Python module the engine needs.
+    module = None
+    #: The supported options, and the engine's name for them.
+    options = {}
+    #: The modules some of the options need, by option name.
+    requires = {}
+
+    @staticmethod
+    def _importable(module):
+        if module is None:
+            return True
+        try:
+            __import__(module)
+        except ImportError:
+            return False
+        return True
+
+    def available(self):
         """
-        self.renderer = renderer
-        self.defaults = defaults
-        if app:
-            self.init_app(app)
+        Whether the engine can be used, that is whether its module can be
+        imported.
+        """
+        return self._importable(self.module)
 
-    def init_app(self, app):
+    def _supports(self, name):
+        return name in self.options and self._importable(self.requires.get(name))
+
+    def unsupported(self, profile):
         """
-        Registers the rendering method as template filter.
+        Returns the sorted names of the options of the profile the engine
+        doesn't support.
+        """
+        names = set()
+        for flags, aliases in ((profile.ext, ALIAS_EXT), (profile.rndr, ALIAS_RENDER)):
+            for name, flag in aliases.items():
+                if flags & flag and not any(self._supports(alias) for alias, other
+                                            in aliases.items() if other == flag):
+                    names.add(name)
+        return sorted(names)
 
-        :param app: a :class:`flask.Flask` instance.
+    def features(self, profile):
         """
-        app.jinja_env.filters.setdefault('markdown', self.render)
+        Returns the engine's names for the options of the profile it
+        supports.
+        """
+        return [feature for name, feature in sorted(self.options.items())
+                if (profile.ext & ALIAS_EXT.get(name, 0) or
+                    profile.rndr & ALIAS_RENDER.get(name, 0)) and self._supports(name)]
 
-    def render(self, text, **overrides):
+    def render(self, text, profile):
         """
-        It delegates to the :func:`markdown` function, passing any default
-        options or renderer set in the :meth:`__init__` method.
+        Renders the text to HTML, without SmartyPants.
+        """
+        raise NotImplementedError
 
-        The ``markdown`` template filter calls this method.
 
-        :param text: Markdown-formatted text to be rendered to HTML
-        :param overrides: Additional options which may override the defaults
-        :return: A :class:`flask.Markup` instance representing the rendered text
+class MisakaEngine(Engine):
+    """
+    Hoedown, through Misaka: the default engine, and the only one supporting
+    every option, :data:`FEATURES` and custom renderers.
+    """
+    options = dict((name, name) for name in list(ALIAS_EXT) + list(ALIAS_RENDER))
+
+    def render(self, text, profile):
+        return misaka.html(text, extensions=profile.ext, render_flags=profile.rndr)
+
+
+class _ThreadLocalEngine(Engine):
+    # the parsers of these engines aren't thread-safe, so each thread builds
+    # its own, once per profile
+    def __init__(self):
+        self._local = threading.local()
+
+    def _parser(self, profile):
+        parsers = getattr(self._local, 'parsers', None)
+        if parsers is None:
+            parsers = self._local.parsers = {}
+        parser = parsers.get(profile)
+        if parser is None:
+            parser = parsers[profile] = self.make_parser(profile)
+        return parser
+
+    def make_parser(self, profile):
+        raise NotImplementedError
+
+
+class MistuneEngine(_ThreadLocalEngine):
+    """
+    `Mistune`_ 2 or later.
+    """
+    module = 'mistune'
+    options = {
+        'autolink': 'url',
+        'footnotes': 'footnotes',
+        'highlight': 'mark',
+        'math': 'math',
+        'strikethrough': 'strikethrough',
+        'superscript': 'superscript',
+        'tables': 'table',
+        'fenced_code': None,
+        'space_headers': None,
+        'escape': None,
+        'hard_wrap': None,
+        'wrap': None,
+    }
+
+    def make_parser(self, profile):
+        import mistune
+        return mistune.create_markdown(
+            escape=bool(profile.rndr & HTML_ESCAPE),
+            hard_wrap=bool(profile.rndr & HTML_HARD_WRAP),
+            plugins=[feature for feature in self.features(profile) if feature])
+
+    def render(self, text, profile):
+        return self._parser(profile)(text)
+
+
+class MarkdownItEngine(_ThreadLocalEngine):
+    """
+    `markdown-it-py`_. Footnotes need ``mdit-py-plugins`` and autolinks
+    ``linkify-it-py``.
+    """
+    module = 'markdown_it'
+    options = {
+        'tables': 'table',
+        'strikethrough': 'strikethrough',
+        'footnotes': 'footnotes',
+        'autolink': 'linkify',
+        'fenced_code': None,
+        'space_headers': None,
+        'escape': None,
+        'hard_wrap': None,
+        'wrap': None,
+        'use_xhtml': None,
+        'xhtml': None,
+    }
+    requires = {'footnotes': 'mdit_py_plugins', 'autolink': 'linkify_it'}
+
+    def make_parser(self, profile):
+        from markdown_it import MarkdownIt
+        features = self.features(profile)
+        parser = MarkdownIt('commonmark', {
+            'html': not profile.rndr & (HTML_ESCAPE | HTML_SKIP_HTML),
+            'breaks': bool(profile.rndr & HTML_HARD_WRAP),
+            'xhtmlOut': bool(profile.rndr & HTML_USE_XHTML),
+            'linkify': 'linkify' in features,
+        })
+        parser.enable([feature for feature in ('table', 'strikethrough', 'linkify')
+                       if feature in features])
+        if 'footnotes' in features:
+            from mdit_py_plugins.footnote import footnote_plugin
+            parser.use(footnote_plugin)
+        return parser
+
+    def render(self, text, profile):
+        return self._parser(profile).render(text)
+
+
+class PythonMarkdownEngine(_ThreadLocalEngine):
+    """
+    `Python-Markdown`_.
+    """
+    module = 'markdown'
+    options = {
+        'tables': 'tables',
+        'fenced_code': 'fenced_code',
+        'footnotes': 'footnotes',
+        'hard_wrap': 'nl2br',
+        'wrap': 'nl2br',
+        'use_xhtml': None,
+        'xhtml': None,
+    }
+
+    def make_parser(self, profile):
+        import markdown
+        return markdown.Markdown(
+            extensions=[feature for feature in self.features(profile) if feature],
+            output_format='xhtml' if profile.rndr & HTML_USE_XHTML else 'html')
+
+    def render(self, text, profile):
+        return self._parser(profile).reset().convert(text)
+
+
+#: The Markdown engines, by name.
+ENGINES = OrderedDict([
+    ('misaka', MisakaEngine()),
+    ('mistune', MistuneEngine()),
+    ('markdown_it', MarkdownItEngine()),
+    ('markdown', PythonMarkdownEngine()),
+])
+
+
+def _render_engine(text, profile):
+    html = ENGINES[profile.engine].render(text, profile)
+    if profile.smartypants:
+        html = misaka.smartypants(html)
+    return Markup(html)
+
+
+def _render(text, profile, md=None):
+    if profile.engine != 'misaka':
+        return _render_engine(text, profile)
+    if profile.features:
+        if md is None:
+            md = misaka.Markdown(_make_renderer(None, profile), profile.ext)
+        md.renderer.reset()
+        html = _render_html(text, profile, md)
+        data = md.renderer.collect()
+        return RenderResult(html, data) if data else html
+    return _render_html(text, profile, md)
+
+
+def _render_html(text, profile, md=None):
+    if (profile.smartypants or profile.nesting != MAX_NESTING) and _lib is not None:
+        return Markup(_render_native(text, profile, md))
+    if md is not None:
+        result = md(text)
+    else:
+        result = misaka.html(text, extensions=profile.ext,
+                             render_flags=profile.rndr)
+    if profile.smartypants:
+        result = misaka.smartypants(result)
+    return Markup(result)
+
+
+def markdown(text, renderer=None, **options):
+    """
+    Parses the provided Markdown-formatted text into valid HTML, and returns
+    it as a :class:`flask.Markup` instance.
+
+    :param text: Markdown-formatted text to be rendered into HTML
+    :param renderer: A custom misaka renderer to be used instead of the default one
+    :param options: Additional options for customizing the default renderer
+    :return: A :class:`flask.Markup` instance representing the rendered text
+    """
+    profile = make_profile(**options)
+    if renderer and profile.features:
+        raise ValueError('Renderer features cannot be used with a custom renderer instance')
+    if renderer and profile.engine != 'misaka':
+        raise ValueError('Custom renderers need the misaka engine')
+    md = misaka.Markdown(renderer, profile.ext) if renderer else None
+    return _render(text, profile, md)
+
+
+BATCH_SIZE = 32
+STREAM_CHUNK_SIZE = 64 * 1024
+ASYNC_THRESHOLD = 16 * 1024
+ASYNC_WORKERS = 4
+EXCERPT_LENGTH = 200
+PRERENDER_MANIFEST = '.misaka-manifest.json'
+
+
+def _render_chunk(texts, profile, md=None):
+    return [_render(text, profile, md) for text in texts]
+
+
+def _render_many(texts, render_chunk, executor=None):
+    unique = list(OrderedDict.fromkeys(texts))
+    if executor is None or len(unique) <= BATCH_SIZE:
+        rendered = render_chunk(unique)
+    else:
+        chunks = [unique[i:i + BATCH_SIZE] for i in range(0, len(unique), BATCH_SIZE)]
+        rendered = [result for chunk in executor.map(render_chunk, chunks)
+                    for result in chunk]
+    return dict(zip(unique, rendered))
+
+
+def markdown_many(texts, renderer=None, executor=None, **options):
+    """
+    Renders each of the given Markdown-formatted texts like :func:`markdown`
+    does, resolving the options only once and rendering identical texts only
+    once.
+
+    Large batches can be spread over a :mod:`concurrent.futures` executor.
+    Hoedown releases the GIL while it renders, so a thread pool is usually
+    enough; process pools work too, but only with the default renderer.
+
+    :param texts: an iterable of Markdown-formatted texts
+    :param renderer: A custom misaka renderer to be used instead of the default one
+    :param executor: an optional executor to render large batches with
+    :param options: Additional options for customizing the default renderer
+    :return: a list of :class:`flask.Markup` instances, in the order of ``texts``
+    """
+    if renderer and executor is not None:
+        raise ValueError('A custom renderer instance cannot be shared by an executor')
+    texts = list(texts)
+    profile = make_profile(**options)
+    if renderer and profile.features:
+        raise ValueError('Renderer features cannot be used with a custom renderer instance')
+    if renderer and profile.engine != 'misaka':
+        raise ValueError('Custom renderers need the misaka engine')
+    md = misaka.Markdown(renderer, profile.ext) if renderer else None
+    rendered = _render_many(texts, functools.partial(_render_chunk, profile=profile, md=md),
+                            executor)
+    return [rendered[text] for text in texts]
+
+
+if Namespace is not None:
+    _signals = Namespace()
+    #: Sent after every render by a :class:`Misaka` instance, with the
+    #: instance as sender and a :class:`RenderEvent` as ``event``.
+    markdown_rendered = _signals.signal('markdown-rendered')
+else:
+    markdown_rendered = None
+
+_timer = getattr(time, 'perf_counter', time.time)
+
+try:
+    _replace = os.replace
+except AttributeError:  # Python 2
+    _replace = os.rename
+
+try:
+    from html import unescape as _unescape
+except ImportError:  # Python 2
+    from HTMLParser import HTMLParser
+    _unescape = HTMLParser().unescape
+
+_TAG_RE = re.compile(r'<[^>]*>')
+_SLUG_RE = re.compile(r'[^\w]+', re.UNICODE)
+
+_FENCE_RE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+_HTML_BLOCK_RE = re.compile(r'^<(!--|[A-Za-z][A-Za-z0-9]*)')
+# the tags Hoedown starts raw HTML blocks with
+_HTML_BLOCK_TAGS = frozenset([
+    'blockquote', 'del', 'div', 'dl', 'fieldset', 'figure', 'form', 'h1', 'h2', 'h3', 'h4',
+    'h5', 'h6', 'iframe', 'ins', 'math', 'noscript', 'ol', 'p', 'pre', 'script', 'style',
+    'table', 'ul',
+])
+# lines which may continue a list or block quote after a blank line
+_CONTINUATION_RE = re.compile(r'^(?:[ \t]|[-*+>|]|\d+[.)])')
+
+
+def _iter_blocks(lines):
+    """
+    Splits Markdown source lines into chunks at blank lines which are known
+    to end a top-level block. When in doubt, lines are kept together, so
+    rendering the chunks one by one gives the same result as rendering the
+    whole document, except for reference links and footnotes whose
+    definitions end up in a different chunk.
+    """
+    block = []
+    fence = None
+    # the tag of the raw HTML block the lines are in, which Hoedown ends at
+    # a line closing it followed by a blank line, or '!--' in a comment
+    html = None
+    closed = False
+    blank = False
+    nested = False
+    for line in lines:
+        if not line.endswith('\n'):
+            line += '\n'
+        if fence is not None:
+            block.append(line)
+            match = _FENCE_RE.match(line)
+            if (match and match.group(1)[0] == fence[0] and
+                    len(match.group(1)) >= len(fence) and
+                    not line[match.end():].strip()):
+                fence = None
+            continue
+        if not line.strip():
+            block.append(line)
+            blank = True
+            if closed:
+                html = None
+                closed = False
+            continue
+        closed = False
+        continuation = _CONTINUATION_RE.match(line)
+        if blank and not html and not (nested and continuation) and \
+                any(l.strip() for l in block):
+            yield ''.join(block)
+            block = []
+        if not any(l.strip() for l in block):
+            nested = False
+        # a list or block quote may start on any line of the block
+        nested = nested or bool(continuation)
+        if html is None:
+            match = _HTML_BLOCK_RE.match(line)
+            if match and (match.group(1) == '!--' or
+                          match.group(1).lower() in _HTML_BLOCK_TAGS):
+                html = match.group(1).lower()
+        if html == '!--':
+            # comments end with their line, blank or not
+            if line.rstrip().endswith('-->'):
+                html = None
+        elif html is not None:
+            closed = line.rstrip().lower() == '</%s>' % html
+        match = _FENCE_RE.match(line)
+        if match:
+            fence = match.group(1)
+        block.append(line)
+        blank = False
+    if block:
+        yield ''.join(block)
+
+
+def _join_blocks(blocks, size):
+    chunk = []
+    length = 0
+    for block in blocks:
+        chunk.append(block)
+        length += len(block)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk = []
+            length = 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+class PlainTextRenderer(misaka.BaseRenderer):
+    """
+    A renderer which outputs the text of the document, without any markup.
+    Blocks are separated by blank lines; raw HTML, footnotes and horizontal
+    rules are left out, and images are replaced by their alternative text.
+    """
+    # Returning an empty string from an inline callback makes Hoedown output
+    # the Markdown source instead, but a NUL character is written as nothing.
+    _EMPTY = '\x00'
+
+    def blockcode(self, text, lang):
+        return text + '\n'
+
+    def blockquote(self, content):
+        return content
+
+    def header(self, content, level):
+        return content + '\n\n'
+
+    def hrule(self):
+        return None
+
+    def list(self, content, is_ordered, is_block):
+        return content + '\n'
+
+    def listitem(self, content, is_ordered, is_block):
+        return content.strip() + '\n'
+
+    def paragraph(self, content):
+        return content + '\n\n'
+
+    def table(self, content):
+        return content + '\n'
+
+    def table_header(self, content):
+        return content
+
+    def table_body(self, content):
+        return content
+
+    def table_row(self, content):
+        return content + '\n'
+
+    def table_cell(self, content, align, is_header):
+        return content + ' '
+
+    def footnotes(self, content):
+        return None
+
+    def footnote_def(self, content, num):
+        return None
+
+    def blockhtml(self, text):
+        return None
+
+    def autolink(self, link, is_email):
+        if is_email and link.startswith('mailto:'):
+            link = link[len('mailto:'):]
+        return link
+
+    def codespan(self, text):
+        return text or self._EMPTY
+
+    def emphasis(self, content):
+        return content or self._EMPTY
+
+    double_emphasis = triple_emphasis = underline = highlight = quote = emphasis
+    strikethrough = superscript = emphasis
+
+    def link(self, content, link, title):
+        return content or self._EMPTY
+
+    def image(self, link, title, alt):
+        return alt or self._EMPTY
+
+    def linebreak(self):
+        return '\n'
+
+    def footnote_ref(self, num):
+        return self._EMPTY
+
+    def math(self, text, displaymode):
+        return text or self._EMPTY
+
+    def raw_html(self, text):
+        return self._EMPTY
+
+    def entity(self, text):
+        return _unescape(text)
+
+    def normal_text(self, text):
+        return text
+
+
+_plain_text_parsers = {}
+_REFERENCE_RE = re.compile(r'^ {0,3}\[[^\]\n]+\]:.*$', re.MULTILINE)
+_FOOTNOTE_REFERENCE_RE = re.compile(r'\[\^[^\]\n]+\](?!:)')
+
+
+def _excerpt(text, max_chars, ellipsis, ext):
+    md = _plain_text_parsers.get(ext)
+    if md is None:
+        md = _plain_text_parsers[ext] = misaka.Markdown(PlainTextRenderer(), ext)
+    # the source is rendered a few blocks at a time, until there is enough
+    # text; reference link and footnote definitions are looked up in the
+    # whole document, so the blocks rendered first still resolve them
+    references = None
+    words = []
+    length = 0
+    for chunk in _join_blocks(_iter_blocks(text.splitlines(True)), max_chars):
+        if ']' in chunk:
+            if references is None:
+                references = '\n'.join(_REFERENCE_RE.findall(text))
+            chunk += '\n\n' + references
+        for word in md(chunk).split():
+            words.append(word)
+            length += len(word) + 1
+        if length > max_chars + 1:
+            break
+    if length <= max_chars + 1:
+        return ' '.join(words)
+
+    max_chars -= len(ellipsis)
+    end = 0
+    length = -1
+    for word in words:
+        if length + 1 + len(word) > max_chars:
+            break
+        length += 1 + len(word)
+        end += 1
+    if end:
+        result = ' '.join(words[:end]).rstrip(',;:')
+    else:
+        result = words[0][:max_chars]
+    return result + ellipsis
+
+
+def excerpt(text, max_chars=EXCERPT_LENGTH, ellipsis='\u2026', **options):
+    """
+    Returns the beginning of the text of the provided Markdown-formatted
+    text, without any markup, for listings and search results. Only as much
+    of the document as needed is rendered, so the cost depends on the length
+    of the excerpt rather than on the length of the document.
+
+    :param text: Markdown-formatted text
+    :param max_chars: the maximum length of the excerpt, ellipsis included
+    :param ellipsis: appended to the excerpt when the text is cut, at a word
+        boundary
+    :param options: Additional options for customizing the parser; the
+        rendering options have no effect
+    :return: A :class:`flask.Markup` instance containing the escaped text
+    """
+    profile = make_profile(**options)
+    return Markup.escape(_excerpt(text, max_chars, ellipsis, profile.ext))
+
+
+def _renderer_name(renderer):
+    if renderer is None:
+        return 'html'
+    if not callable(renderer):
+        renderer = type(renderer)
+    return '%s.%s' % (renderer.__module__,
+                      getattr(renderer, '__name__', type(renderer).__name__))
+
+
+def _digest(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _prerender_file(source, destination, render, digest):
+    with io.open(source, encoding='utf-8') as f:
+        text = f.read()
+    new_digest = _digest(text)
+    if new_digest == digest:
+        return new_digest, False
+    _atomic_write(destination, render(text).encode('utf-8'))
+    return new_digest, True
+
+
+class BaseCache(object):
+    """
+    The interface of the render cache backends used by :class:`Misaka`.
+    Keys and values are text strings, unless :attr:`stores_objects` is
+    true, in which case values are stored as they are. Backends count
+    ``hits`` and ``misses`` of their own process.
+    """
+    stores_objects = False
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the cached value for ``key``, or ``None`` if there is none.
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, timeout=None):
+        """
+        Stores ``value`` under ``key``, for at most ``timeout`` seconds if a
+        timeout is given.
+        """
+        raise NotImplementedError
+
+    def invalidate(self):
+        """
+        Drops every cached entry. The hit and miss counters are kept.
+        """
+        raise NotImplementedError
+
+
+def _cache_get(cache, key, profile):
+    result = cache.get(key)
+    if result is None or isinstance(result, Markup):
+        return result
+    if not profile.features:
+        return Markup(result)
+    value = json.loads(result)
+    for name in profile.features:
+        (FEATURES.get(name) or _HOOK_FEATURES[name]).load(value['data'])
+    if value['data']:
+        return RenderResult(value['html'], value['data'])
+    return Markup(value['html'])
+
+
+def _cache_set(cache, key, result, profile):
+    if profile.features and not cache.stores_objects:
+        result = json.dumps({'html': result, 'data': getattr(result, 'data', {})})
+    cache.set(key, result)
+
+
+class RenderCache(BaseCache):
+    """
+    A thread-safe, in-process LRU cache for rendered Markdown.
+
+    Entries are evicted in least-recently-used order as soon as either limit
+    is exceeded. Sizes are measured with :func:`sys.getsizeof`, so
+    ``max_bytes`` bounds the memory held by the cached strings themselves.
+
+    :param max_entries: maximum number of cached documents, or ``None``
+    :param max_bytes: maximum total size of the cached documents, or ``None``
+    """
+    stores_objects = True
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024):
+        BaseCache.__init__(self)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, size, expires = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires <= time.time():
+                self.size -= size
+                self.misses += 1
+                return None
+            self._entries[key] = (value, size, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, timeout=None):
+        """
+        Stores ``value`` under ``key``, evicting old entries as needed.
+        Values larger than ``max_bytes`` are not stored at all.
+        """
+        size = sys.getsizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        expires = time.time() + timeout if timeout else None
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size, expires)
+            self.size += size
+            while self._entries and (
+                    (self.max_entries is not None and
+                     len(self._entries) > self.max_entries) or
+                    (self.max_bytes is not None and self.size > self.max_bytes)):
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.size -= evicted
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+def _atomic_write(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        _replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class FileSystemCache(BaseCache):
+    """
+    A render cache stored as files in a directory, which can be shared by
+    all the worker processes on a machine and survives restarts.
+
+    Every entry is written to a temporary file first and then moved into
+    place, so readers never see partial entries. The limits are enforced
+    every :attr:`prune_interval` writes, by deleting the least recently
+    used entries, so they can be briefly exceeded.
+
+    :param directory: the directory to store the entries in; it is created
+        if it doesn't exist
+    :param max_entries: maximum number of cached documents, or ``None``
+    :param max_bytes: maximum total size of the cache files, or ``None``
+    """
+    suffix = '.misaka'
+    prune_interval = 64
+
+    def __init__(self, directory, max_entries=10000, max_bytes=256 * 1024 * 1024):
+        BaseCache.__init__(self)
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._writes = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, _digest(key) + self.suffix)
+
+    def _files(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith(self.suffix)]
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                expires, _, value = f.read().partition(b'\n')
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        try:
+            expired = expires and float(expires) <= time.time()
+        except ValueError:
+            # a malformed entry, which is removed too
+            expired = True
+        if expired:
+            self._remove(path)
+            self.misses += 1
+            return None
+        try:
+            # the modification time is used as access time when pruning
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return value.decode('utf-8')
+
+    def set(self, key, value, timeout=None):
+        expires = ('%f' % (time.time() + timeout)) if timeout else ''
+        _atomic_write(self._path(key),
+                      expires.encode('ascii') + b'\n' + value.encode('utf-8'))
+        self._writes += 1
+        if self._writes % self.prune_interval == 0:
+            self.prune()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def prune(self):
+        """
+        Deletes the least recently used entries until the cache is within
+        its limits again.
+        """
+        entries = []
+        for path in self._files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        size = sum(entry[1] for entry in entries)
+        count = len(entries)
+        for _, entry_size, path in entries:
+            if (self.max_entries is None or count <= self.max_entries) and \
+                    (self.max_bytes is None or size <= self.max_bytes):
+                break
+            self._remove(path)
+            count -= 1
+            size -= entry_size
+
+    def invalidate(self):
+        for path in self._files():
+            self._remove(path)
+
+
+class RedisCache(BaseCache):
+    """
+    A render cache stored in a Redis server, or anything else that speaks
+    the Redis protocol, shared by every process that can reach it. Limit
+    its size with the server's ``maxmemory`` setting.
+
+    Connection errors and error replies, like those of a full server with
+    the ``noeviction`` policy, are treated like cache misses, so rendering
+    keeps working while the server is unavailable.
+
+    :param host: the host name of the server
+    :param port: the port of the server
+    :param unix_socket_path: the path of a Unix socket to connect to
+        instead of ``host`` and ``port``
+    :param prefix: a prefix for all the keys stored by this cache
+    :param socket_timeout: the timeout for connecting and for each command,
+        in seconds
+    """
+    def __init__(self, host='localhost', port=6379, unix_socket_path=None,
+                 prefix='flask_misaka:', socket_timeout=1.0):
+        BaseCache.__init__(self)
+        self.host = host
+        self.port = port
+        self.unix_socket_path = unix_socket_path
+        self.prefix = prefix
+        self.socket_timeout = socket_timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        if self.unix_socket_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.socket_timeout)
+            sock.connect(self.unix_socket_path)
+        else:
+            sock = socket.create_connection((self.host, self.port), self.socket_timeout)
+        return sock, sock.makefile('rb')
+
+    def _command(self, *args):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        sock, reader = connection
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = ('%s' % arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        try:
+            sock.sendall(b''.join(parts))
+            return self._read_reply(reader)
+        except (socket.error, EOFError):
+            self._disconnect()
+            raise
+
+    def _disconnect(self):
+        connection = getattr(self._local, 'connection', None)
+        self._local.connection = None
+        if connection is not None:
+            connection[1].close()
+            connection[0].close()
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise EOFError('Connection closed by the cache server')
+        kind, line = line[:1], line[1:-2]
+        if kind == b'+':
+            return line
+        if kind == b'-':
+            raise RedisError(line.decode('utf-8', 'replace'))
+        if kind == b':':
+            return int(line)
+        if kind == b'$':
+            length = int(line)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            if len(data) < length + 2:
+                raise EOFError('Connection closed by the cache server')
+            return data[:-2]
+        if kind == b'*':
+            length = int(line)
+            if length < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(length)]
+        raise RedisError('Unexpected reply from the cache server: %r' % kind)
+
+    def get(self, key):
+        try:
+            value = self._command('GET', self.prefix + key)
+        except (socket.error, EOFError, RedisError):
+            value = None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value.decode('utf-8')
+
+    def set(self, key, value, timeout=None):
+        args = ['SET', self.prefix + key, value.encode('utf-8')]
+        if timeout:
+            args.extend(['EX', int(math.ceil(timeout))])
+        try:
+            self._command(*args)
+        except (socket.error, EOFError, RedisError):
+            pass
+
+    def invalidate(self):
+        """
+        Deletes every key starting with the prefix of this cache.
+        """
+        cursor = b'0'
+        pattern = self.prefix.replace('*', '\\*') + '*'
+        try:
+            while True:
+                cursor, keys = self._command('SCAN', cursor, 'MATCH', pattern, 'COUNT', 1000)
+                if keys:
+                    self._command('DEL', *keys)
+                if cursor == b'0':
+                    break
+        except (socket.error, EOFError, RedisError):
+            pass
+
+
+class RedisError(Exception):
+    """
+    An error reply from the server used by a :class:`RedisCache`.
+    """
+
+
+class RenderEvent(namedtuple('RenderEvent',
+                             'duration input_size output_size cache_hit profile')):
+    """
+    Describes a single render: how long it took in seconds, the sizes of the
+    input and output in bytes, whether the result came from the cache, and
+    the :class:`Profile` it was rendered with.
+    """
+    __slots__ = ()
+
+
+class RenderStats(object):
+    """
+    Aggregates :class:`RenderEvent` instances into totals and a histogram of
+    render durations, in a form suitable to dump from an admin view.
+
+    :param buckets: the upper bounds of the histogram buckets, in seconds
+    """
+    def __init__(self, buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)):
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """
+        Starts over from zero.
+        """
+        with self._lock:
+            self.count = 0
+            self.cache_hits = 0
+            self.total_time = 0.0
+            self.max_time = 0.0
+            self.input_bytes = 0
+            self.output_bytes = 0
+            self.histogram = [0] * len(self.buckets)
+            self.profiles = {}
+
+    def record(self, event):
+        """
+        Adds a :class:`RenderEvent` to the statistics.
+        """
+        index = bisect.bisect_left(self.buckets, event.duration)
+        fingerprint = event.profile.fingerprint
+        with self._lock:
+            self.count += 1
+            self.cache_hits += event.cache_hit
+            self.total_time += event.duration
+            self.max_time = max(self.max_time, event.duration)
+            self.input_bytes += event.input_size
+            self.output_bytes += event.output_size
+            self.histogram[index] += 1
+            self.profiles[fingerprint] = self.profiles.get(fingerprint, 0) + 1
+
+    def percentile(self, percent):
+        """
+        Estimates a percentile of the render durations, as the upper bound of
+        the histogram bucket it falls into. Returns ``None`` if nothing was
+        recorded yet.
+        """
+        with self._lock:
+            if not self.count:
+                return None
+            rank = self.count * percent / 100.0
+            seen = 0
+            for bound, count in zip(self.buckets, self.histogram):
+                seen += count
+                if count and seen >= rank:
+                    return min(bound, self.max_time)
+            return self.max_time
+
+    def as_dict(self):
+        """
+        Returns the statistics as a JSON-serializable dictionary.
+        """
+        with self._lock:
+            data = {
+                'count': self.count,
+                'cache_hits': self.cache_hits,
+                'total_time': self.total_time,
+                'mean_time': self.total_time / self.count if self.count else 0.0,
+                'max_time': self.max_time,
+                'input_bytes': self.input_bytes,
+                'output_bytes': self.output_bytes,
+                'histogram': [[None if bound == float('inf') else bound, count]
+                              for bound, count in zip(self.buckets, self.histogram)],
+                'profiles': dict(self.profiles),
+            }
+        for percent in (50, 90, 99):
+            data['p%d' % percent] = self.percentile(percent)
+        return data
+
+
+_text_type = type('')
+
+
+def _template_misaka(environment, name='markdown'):
+    # the Misaka instance whose render method is the given filter, if any
+    method = environment.filters.get(name)
+    instance = getattr(method, '__self__', None)
+    if isinstance(instance, Misaka) and getattr(method, '__func__', None) in (
+            Misaka.render, Misaka.render_async):
+        return instance
+    return None
+
+
+class MarkdownExtension(Extension):
+    """
+    A Jinja extension, added by :meth:`Misaka.init_app`, which renders the
+    Markdown of ``{% filter markdown %}`` blocks when the template is
+    compiled, if they only contain literal text:
+
+    .. code-block:: jinja
+
+      {% filter markdown %}
+      This is rendered *once*.
+      {% endfilter %}
+
+    Blocks containing variables or tags are still rendered on every
+    request, and so are all of them if the ``markdown`` filter isn't the
+    one of a :class:`Misaka` instance.
+
+    It also adds the ``markdown`` tag, which renders its body and keeps the
+    result in the cache of the :class:`Misaka` instance under the given
+    ``key``, for ``ttl`` seconds or as long as the cache keeps it. The body
+    is only evaluated and rendered when the key isn't in the cache. Other
+    arguments are options, which override the defaults:
+
+    .. code-block:: jinja
+
+      {% markdown key=post.id ~ ':' ~ post.revision, ttl=3600, toc=True %}
+      {{ post.body }}
+      {% endmarkdown %}
+    """
+    tags = set(['markdown'])
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        kwargs = []
+        while parser.stream.current.type != 'block_end':
+            if kwargs:
+                parser.stream.expect('comma')
+            name = parser.stream.expect('name')
+            parser.stream.expect('assign')
+            kwargs.append(nodes.Keyword(name.value, parser.parse_expression(),
+                                        lineno=name.lineno))
+        body = parser.parse_statements(['name:endmarkdown'], drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render_block', kwargs=kwargs),
+                               [], [], body).set_lineno(lineno)
+
+    def _render_block(self, caller, key=None, ttl=None, **overrides):
+        instance = _template_misaka(self.environment)
+        if instance is None:
+            raise TemplateRuntimeError('The markdown tag needs the markdown filter of Misaka')
+        if key is not None and instance.cache is not None:
+            key = 'fragment:%s:%s' % (instance.fingerprint(**overrides), key)
+            html = instance.cache.get(key)
+        else:
+            key = html = None
+        if self.environment.is_async:
+            return self._render_block_async(instance, caller, key, ttl, overrides, html)
+        if html is None:
+            html = _text_type(instance.render(caller(), **overrides))
+            if key is not None:
+                instance.cache.set(key, html, ttl)
+        return Markup(html)
+
+    @staticmethod
+    def _render_block_async(instance, caller, key, ttl, overrides, html):
+        # in async environments the body is a coroutine, and Jinja awaits
+        # the future returned here
+        import asyncio
+        loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+        future = loop.create_future()
+        if html is not None:
+            future.set_result(Markup(html))
+            return future
+
+        def rendered(task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                html = _text_type(task.result())
+                if key is not None:
+                    instance.cache.set(key, html, ttl)
+                future.set_result(Markup(html))
+
+        def evaluated(task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                instance.render_async(task.result(), **overrides).add_done_callback(rendered)
+
+        asyncio.ensure_future(caller()).add_done_callback(evaluated)
+        return future
+
+    def filter_stream(self, stream):
+        tokens = list(stream)
+        instance = _template_misaka(self.environment)
+        if instance is None:
+            return tokens
+        result = []
+        i = 0
+        while i < len(tokens):
+            end = self._literal_block(tokens, i)
+            if end is None:
+                result.append(tokens[i])
+                i += 1
+                continue
+            body = ''.join(token.value for token in tokens[i + 4:end - 3])
+            result.append(Token(tokens[i].lineno, 'data', _text_type(instance.render(body))))
+            i = end
+        return result
+
+    @staticmethod
+    def _literal_block(tokens, i):
+        # returns the index after {% filter markdown %}...{% endfilter %}
+        # if the block only contains data
+        def match(index, kind, value=None):
+            return (index < len(tokens) and tokens[index].type == kind and
+                    (value is None or tokens[index].value == value))
+
+        if not (match(i, 'block_begin') and match(i + 1, 'name', 'filter') and
+                match(i + 2, 'name', 'markdown') and match(i + 3, 'block_end')):
+            return None
+        j = i + 4
+        while match(j, 'data'):
+            j += 1
+        if (match(j, 'block_begin') and match(j + 1, 'name', 'endfilter') and
+                match(j + 2, 'block_end')):
+            return j + 3
+        return None
+
+
+class RenderLimitExceeded(Exception):
+    """
+    Raised when a text exceeds one of the limits of a :class:`Misaka`
+    instance, if its ``on_limit`` policy is ``'raise'``.
+    """
+
+
+# classes built by element_renderer can't be pickled, so worker processes are
+# sent the overrides, and build the class again
+_ElementOverrides = namedtuple('_ElementOverrides', 'name elements base')
+
+
+def _worker_main(conn):
+    parsers = {}
+    renderers = {}
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            break
+        if task is None:
+            break
+        factory, text, profile = task
+        try:
+            if isinstance(factory, _ElementOverrides):
+                overrides = factory
+                factory = renderers.get(overrides.name)
+                if factory is None:
+                    factory = renderers[overrides.name] = element_renderer(overrides.elements,
+                                                                           overrides.base)
+            md = None
+            if factory is not None or profile.features:
+                md = parsers.get((factory, profile))
+                if md is None:
+                    md = parsers[factory, profile] = misaka.Markdown(
+                        _make_renderer(factory, profile), profile.ext)
+            result = _render(text, profile, md)
+            conn.send((True, _text_type(result), getattr(result, 'data', None)))
+        except Exception as e:
+            try:
+                conn.send((False, e, None))
+            except Exception:
+                conn.send((False, RuntimeError(repr(e)), None))
+
+
+class _WorkerPool(object):
+    """
+    Worker processes which render one text at a time, and are killed and
+    replaced when a text takes too long.
+    """
+    def __init__(self, size):
+        self._slots = threading.Semaphore(size)
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _spawn(self):
+        conn, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_worker_main, args=(child,))
+        process.daemon = True
+        process.start()
+        child.close()
+        return process, conn
+
+    def render(self, task, timeout):
+        with self._slots:
+            with self._lock:
+                worker = self._idle.pop() if self._idle else None
+            if worker is None or not worker[0].is_alive():
+                worker = self._spawn()
+            process, conn = worker
+            try:
+                conn.send(task)
+                if not conn.poll(timeout):
+                    process.terminate()
+                    process.join()
+                    conn.close()
+                    worker = None
+                    raise RenderLimitExceeded('Rendering took more than %g seconds' % timeout)
+                return conn.recv()
+            except (EOFError, IOError, OSError):
+                worker = None
+                raise
+            finally:
+                if worker is not None:
+                    with self._lock:
+                        self._idle.append(worker)
+
+    def close(self):
+        with self._lock:
+            workers, self._idle = self._idle, []
+        for process, conn in workers:
+            conn.send(None)
+            conn.close()
+            process.join(1)
+
+
+def _truncate(text, max_bytes):
+    text = text.encode('utf-8')[:max_bytes].decode('utf-8', 'ignore')
+    end = text.rfind('\n')
+    return text[:end + 1] if end > 0 else text
+
+
+ON_LIMIT = ('raise', 'escape', 'truncate')
+
+
+class Misaka(object):
+    def __init__(self, app=None, renderer=None, cache=None,
+                 async_threshold=ASYNC_THRESHOLD, async_executor=None,
+                 stats=None, on_render=None, math_renderer=None, math_batch=False,
+                 math_cache=None, max_input_size=None, max_nesting=None,
+                 render_timeout=None, on_limit='raise', elements=None, **defaults):
+        """
+        Set the default options for the :meth:`render` method. If you want
+        the ``markdown`` template filter to use options, set them here.
+
+        A custom misaka renderer can be specified to be used instead of the
+        default one. Misaka renderers carry state while rendering, so a
+        renderer instance is only ever used by one thread at a time; renders
+        through it are serialized. To render in parallel, pass a renderer
+        class (or any callable returning a renderer) instead, and each thread
+        will get its own renderer instance. Either way, the
+        :class:`misaka.Markdown` objects wrapping the renderer are built once
+        per set of extensions and reused.
+
+        Pass ``cache=True`` (or a :class:`RenderCache` instance) to keep
+        rendered documents in memory, keyed by a hash of the text, the
+        resolved options and the renderer class. Any other
+        :class:`BaseCache`, like a :class:`FileSystemCache` or a
+        :class:`RedisCache`, can be used as well. Renderers of the same class
+        are assumed to produce the same output when a cache is shared between
+        several :class:`Misaka` instances or processes, so such a cache needs
+        a renderer class rather than an instance, whose flags the class
+        doesn't tell.
+
+        :meth:`render_async` renders texts shorter than ``async_threshold``
+        characters right away, and longer ones on ``async_executor``. By
+        default that is a thread pool of :data:`ASYNC_WORKERS` threads, which
+        also limits how many large documents are rendered at the same time.
+
+        Renders are timed and measured only on request: pass ``stats=True``
+        (or a :class:`RenderStats` instance) to aggregate them in
+        :attr:`stats`, or an ``on_render`` callback to receive a
+        :class:`RenderEvent` for each of them. The
+        :data:`markdown_rendered` signal is sent as well, as long as it has
+        receivers.
+
+        With the ``math`` extension, formulas can be rendered on the server
+        by a ``math_renderer``, called with the TeX source of a formula and
+        whether it is a display formula, and returning its HTML. With
+        ``math_batch=True``, it is called once per document instead, with
+        the list of ``(tex, display)`` pairs not found in ``math_cache``,
+        and returns the list of their HTML. Returning ``None`` for a
+        formula leaves it to be rendered in the browser. The rendered
+        formulas are kept in ``math_cache``, an in-process
+        :class:`RenderCache` by default. The hook needs the default renderer
+        or a renderer class.
+
+        ``elements`` changes how some elements are rendered, declaratively,
+        with a renderer class built by :func:`element_renderer`, which
+        extends ``renderer`` if it is a class:
+
+        .. code-block:: python
+
+          md = Misaka(app, elements={'table': {'class': 'table'},
+                                     'link': {'rel': 'nofollow'}})
+
+        Untrusted texts can be held to limits: ``max_input_size`` bytes of
+        UTF-8, a ``max_nesting`` depth of nested blocks and spans, beyond
+        which Hoedown leaves the content out, and a ``render_timeout``
+        in seconds. With a timeout, texts are rendered in worker processes,
+        up to :data:`ASYNC_WORKERS` at a time, and a worker which runs out
+        of time is killed. ``on_limit`` decides what happens to a text over
+        the size or time limit: ``'raise'`` raises
+        :exc:`RenderLimitExceeded`, ``'escape'`` returns the escaped text in
+        a ``<pre>`` element, and ``'truncate'`` renders the beginning of a
+        text which is too large, and escapes a text which takes too long.
+        The result of ``'escape'`` and ``'truncate'`` is cached like any
+        other, so a bad text doesn't keep workers busy.
+
+        The defaults are resolved into a :class:`Profile` right away, and
+        unknown option names raise a warning; changing :attr:`defaults`
+        afterwards has no effect.
+        """
+        if on_limit not in ON_LIMIT:
+            raise ValueError('on_limit must be one of %s' % ', '.join(ON_LIMIT))
+        worker_renderer = renderer
+        if elements:
+            if renderer is not None and not isinstance(renderer, type):
+                raise ValueError('Element overrides need the default renderer or a renderer class')
+            base = renderer
+            renderer = element_renderer(elements, base)
+            worker_renderer = _ElementOverrides(renderer.__name__, elements, base)
+        if render_timeout is not None and not (renderer is None or isinstance(renderer, type)):
+            raise ValueError('A render timeout needs the default renderer or a renderer class')
+        self.renderer = renderer
+        self._worker_renderer = worker_renderer
+        self.max_input_size = max_input_size
+        self.max_nesting = max_nesting
+        self.render_timeout = render_timeout
+        self.on_limit = on_limit
+        self._guarded = max_input_size is not None or render_timeout is not None
+        self._workers = None
+        self.math_renderer = math_renderer
+        self.math_batch = math_batch
+        if math_renderer is not None and math_cache is None:
+            math_cache = RenderCache()
+        self.math_cache = math_cache
+        self.defaults = defaults
+        # overrides are combined with the defaults as they were given, like
+        # the profile of the defaults themselves
+        self._defaults = dict(defaults)
+        self.profile = self._make_profile(defaults)
+        self._profiles = {}
+        self._parsers = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if cache is True:
+            cache = RenderCache()
+        if (cache is not None and not isinstance(cache, RenderCache) and
+                renderer is not None and not callable(renderer)):
+            # the flags of an instance can't be told from its class, so they
+            # aren't part of the keys other instances look up
+            raise ValueError('Caches shared by several instances need a renderer class')
+        self.cache = cache
+        self.async_threshold = async_threshold
+        self.async_executor = async_executor
+        if stats is True:
+            stats = RenderStats()
+        self.stats = stats
+        self.on_render = on_render
+        if app:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """
+        Registers the rendering method as template filter. If the template
+        environment has async support enabled, like Quart's does, the filter
+        uses :meth:`render_async` instead. :meth:`excerpt` is registered as
+        the ``markdown_excerpt`` filter, and the :class:`MarkdownExtension`
+        is added to the template environment.
+
+        :param app: a :class:`flask.Flask` instance.
+        """
+        if getattr(app.jinja_env, 'is_async', False):
+            app.jinja_env.filters.setdefault('markdown', self.render_async)
+        else:
+            app.jinja_env.filters.setdefault('markdown', self.render)
+        app.jinja_env.filters.setdefault('markdown_excerpt', self.excerpt)
+        app.jinja_env.add_extension(MarkdownExtension)
+        if hasattr(app, 'cli'):
+            app.cli.add_command(self._make_cli())
+
+    def _make_cli(self):
+        import click
+
+        @click.group('misaka')
+        def cli():
+            """Markdown rendering commands."""
+
+        @cli.command('prerender')
+        @click.argument('src', type=click.Path(exists=True, file_okay=False))
+        @click.argument('dest', type=click.Path(file_okay=False))
+        @click.option('--jobs', '-j', type=int, default=None,
+                      help='Number of processes to use, all cores by default.')
+        @click.option('--pattern', default='*.md', show_default=True,
+                      help='File name pattern of the Markdown files.')
+        def prerender(src, dest, jobs, pattern):
+            """Render the Markdown files in SRC to HTML files in DEST."""
+            rendered, unchanged = self.prerender(src, dest, jobs=jobs, pattern=pattern)
+            click.echo('Rendered %d files, %d unchanged.' % (rendered, unchanged))
+
+        return cli
+
+    def _make_profile(self, options):
+        unknown = set(options) - OPTIONS
+        if unknown:
+            warnings.warn('Unknown Misaka options: %s' % ', '.join(sorted(unknown)),
+                          stacklevel=3)
+        profile = make_profile(**options)
+        if self.renderer is not None and profile.engine != 'misaka':
+            raise ValueError('Custom renderers need the misaka engine')
+        if (self.math_renderer is not None and profile.ext & EXT_MATH and
+                profile.engine == 'misaka' and
+                (self.renderer is None or callable(self.renderer))):
+            profile = profile._replace(
+                features=tuple(sorted(profile.features + ('math_renderer',))))
+        if self.max_nesting is not None:
+            profile = profile._replace(nesting=self.max_nesting)
+        return profile
+
+    def get_profile(self, **overrides):
+        """
+        Returns the :class:`Profile` for the defaults combined with the given
+        overrides. Profiles are memoized per combination of overrides.
+        """
+        if not overrides:
+            return self.profile
+        try:
+            key = frozenset(overrides.items())
+            return self._profiles[key]
+        except TypeError:
+            key = None
+        except KeyError:
+            pass
+        options = dict(self._defaults)
+        options.update(overrides)
+        profile = self._make_profile(options)
+        if key is not None:
+            self._profiles[key] = profile
+        return profile
+
+    def fingerprint(self, **overrides):
+        """
+        Returns a string identifying the renderer and the options used for
+        the given overrides, which changes whenever they would render
+        differently.
+        """
+        return self._fingerprint(self.get_profile(**overrides))
+
+    def _fingerprint(self, profile):
+        fingerprint = '%s:%s' % (_renderer_name(self.renderer), profile.fingerprint)
+        if 'math_renderer' in profile.features:
+            fingerprint += ':' + _renderer_name(self.math_renderer)
+        return fingerprint
+
+    def _cache_key(self, text, profile):
+        return '%s:%s' % (self._fingerprint(profile), _digest(text))
+
+    def _render_profile(self, text, profile):
+        if (self.max_input_size is not None and len(text) * 4 > self.max_input_size and
+                len(text.encode('utf-8')) > self.max_input_size):
+            if self.on_limit != 'truncate':
+                return self._limit_exceeded(
+                    text, 'The text is larger than %d bytes' % self.max_input_size)
+            text = _truncate(text, self.max_input_size)
+        if self.render_timeout is not None:
+            try:
+                return self._render_worker(text, profile)
+            except RenderLimitExceeded as e:
+                return self._limit_exceeded(text, e.args[0])
+
+        if self.renderer is None and not profile.features:
+            return _render(text, profile)
+
+        if self.renderer is None or callable(self.renderer):
+            parsers = getattr(self._local, 'parsers', None)
+            if parsers is None:
+                parsers = self._local.parsers = {}
+            md = parsers.get(profile)
+            if md is None:
+                md = parsers[profile] = misaka.Markdown(
+                    _make_renderer(self.renderer, profile), profile.ext)
+            result = _render(text, profile, md)
+            if 'math_renderer' in profile.features:
+                result = self._render_math(result)
+            return result
+
+        if profile.features:
+            raise ValueError('Renderer features need the default renderer or a renderer class')
+        with self._lock:
+            md = self._parsers.get(profile.ext)
+            if md is None:
+                md = self._parsers[profile.ext] = misaka.Markdown(self.renderer, profile.ext)
+            return _render(text, profile, md)
+
+    def _limit_exceeded(self, text, message):
+        if self.on_limit == 'raise':
+            raise RenderLimitExceeded(message)
+        return Markup('<pre>%s</pre>\n') % text
+
+    def _render_worker(self, text, profile):
+        if self._workers is None:
+            with self._lock:
+                if self._workers is None:
+                    self._workers = _WorkerPool(ASYNC_WORKERS)
+        ok, html, data = self._workers.render((self._worker_renderer, text, profile),
+                                              self.render_timeout)
+        if not ok:
+            raise html
+        result = RenderResult(html, data) if data else Markup(html)
+        if 'math_renderer' in profile.features:
+            result = self._render_math(result)
+        return result
+
+    def _render_math(self, result):
+        data = result.data
+        token, formulas = data.pop('math')
+        html = Markup(result)
+        if formulas:
+            rendered = self._render_formulas(formulas)
+
+            def replace(match):
+                index = int(match.group(2))
+                if match.group(1) != token or index >= len(rendered):
+                    return match.group(0)
+                return rendered[index]
+
+            html = Markup(_MATH_RE.sub(replace, html))
+        return RenderResult(html, data) if data else html
+
+    def _render_formulas(self, formulas):
+        keys = ['math:%d:%s' % (display, _digest(tex)) for tex, display in formulas]
+        found = {}
+        for key in set(keys):
+            html = self.math_cache.get(key)
+            if html is not None:
+                found[key] = html
+        missing = OrderedDict((key, formula) for key, formula in zip(keys, formulas)
+                              if key not in found)
+        if missing:
+            if self.math_batch:
+                results = self.math_renderer(list(missing.values()))
+            else:
+                results = [self.math_renderer(tex, display) for tex, display in missing.values()]
+            for (key, (tex, display)), html in zip(missing.items(), results):
+                if html is None:
+                    html = _html_math(tex, display)
+                else:
+                    self.math_cache.set(key, html)
+                found[key] = html
+        return [found[key] for key in keys]
+
+    def render(self, text, **overrides):
+        """
+        It delegates to the :func:`markdown` function, passing any default
+        options or renderer set in the :meth:`__init__` method.
+
+        The ``markdown`` template filter calls this method.
+
+        :param text: Markdown-formatted text to be rendered to HTML
+        :param overrides: Additional options which may override the defaults
+        :return: A :class:`flask.Markup` instance representing the rendered text
+        """
+        return self._render_cached(text, self.get_profile(**overrides))
+
+    def _instrumented(self):
+        return (self.stats is not None or self.on_render is not None or
+                bool(markdown_rendered is not None and markdown_rendered.receivers))
+
+    def _record(self, start, text, result, cache_hit, profile):
+        event = RenderEvent(_timer() - start, len(text.encode('utf-8')),
+                            len(result.encode('utf-8')), cache_hit, profile)
+        if self.stats is not None:
+            self.stats.record(event)
+        if self.on_render is not None:
+            self.on_render(event)
+        if markdown_rendered is not None:
+            markdown_rendered.send(self, event=event)
+
+    def _render_cached(self, text, profile):
+        if not self._instrumented():
+            return self._lookup(text, profile)[0]
+        start = _timer()
+        result, cache_hit = self._lookup(text, profile)
+        self._record(start, text, result, cache_hit, profile)
+        return result
+
+    def _lookup(self, text, profile):
+        if self.cache is None:
+            return self._render_profile(text, profile), False
+
+        key = self._cache_key(text, profile)
+        result = _cache_get(self.cache, key, profile)
+        if result is not None:
+            return result, True
+        result = self._render_profile(text, profile)
+        _cache_set(self.cache, key, result, profile)
+        return result, False
+
+    def excerpt(self, text, max_chars=EXCERPT_LENGTH, ellipsis='\u2026', **overrides):
+        """
+        Returns the beginning of the text of a Markdown document, without
+        any markup, like the :func:`excerpt` function. The custom renderer,
+        if any, isn't used.
+
+        The ``markdown_excerpt`` template filter calls this method:
+
+        .. code-block:: jinja
+
+          <p>{{ post.body|markdown_excerpt(160) }}</p>
+
+        :param text: Markdown-formatted text
+        :param max_chars: the maximum length of the excerpt, ellipsis included
+        :param ellipsis: appended to the excerpt when the text is cut
+        :param overrides: Additional options which may override the defaults
+        :return: A :class:`flask.Markup` instance containing the escaped text
+        """
+        profile = self.get_profile(**overrides)
+        if self.cache is None:
+            return Markup.escape(_excerpt(text, max_chars, ellipsis, profile.ext))
+        key = 'excerpt:%d:%s:%s:%s' % (max_chars, _digest(ellipsis), profile.ext, _digest(text))
+        result = self.cache.get(key)
+        if result is None:
+            result = Markup.escape(_excerpt(text, max_chars, ellipsis, profile.ext))
+            self.cache.set(key, result)
+        return Markup(result)
+
+    def render_async(self, text, **overrides):
+        """
+        Like :meth:`render`, but returns an awaitable, for use in coroutines:
+
+        .. code-block:: python
+
+          html = await md.render_async(text)
+
+        Large texts are rendered on the async executor instead of blocking
+        the event loop, see :meth:`__init__`.
+
+        :param text: Markdown-formatted text to be rendered to HTML
+        :param overrides: Additional options which may override the defaults
+        :return: an awaitable resolving to a :class:`flask.Markup` instance
+        """
+        import asyncio
+        loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)()
+        profile = self.get_profile(**overrides)
+        if len(text) >= self.async_threshold:
+            if self.async_executor is None:
+                with self._lock:
+                    if self.async_executor is None:
+                        from concurrent.futures import ThreadPoolExecutor
+                        self.async_executor = ThreadPoolExecutor(ASYNC_WORKERS)
+            return loop.run_in_executor(self.async_executor, self._render_cached,
+                                        text, profile)
+
+        future = loop.create_future()
+        try:
+            future.set_result(self._render_cached(text, profile))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def render_stream(self, source, chunk_size=None, **overrides):
+        """
+        Renders a large Markdown document piece by piece, yielding
+        :class:`flask.Markup` chunks as soon as they are rendered, so neither
+        the whole document nor the whole output has to be held in memory.
+        The generator can be passed straight to a :class:`flask.Response`:
+
+        .. code-block:: python
+
+          with open(path) as f:
+              return Response(stream_with_context(md.render_stream(f)))
+
+        The source is only split at blank lines which certainly end a
+        top-level block, so the output matches :meth:`render`, with one
+        exception: reference links and footnotes are only resolved within
+        the same chunk.
+
+        :param source: a file object, an iterable of lines or a string
+        :param chunk_size: the minimum amount of source text, in characters,
+            rendered at once; defaults to :data:`STREAM_CHUNK_SIZE`
+        :param overrides: Additional options which may override the defaults
+        """
+        if hasattr(source, 'splitlines'):
+            source = source.splitlines(True)
+        if chunk_size is None:
+            chunk_size = STREAM_CHUNK_SIZE
+        profile = self.get_profile(**overrides)
+        started = False
+        for chunk in _join_blocks(_iter_blocks(source), chunk_size):
+            result = self._render_cached(chunk, profile)
+            if not result:
+                continue
+            # Hoedown puts a newline between consecutive blocks
+            if started:
+                yield Markup('\n')
+            started = True
+            yield result
+
+    def _render_texts(self, texts, profile):
+        return [self._render_profile(text, profile) for text in texts]
+
+    def render_many(self, texts, executor=None, **overrides):
+        """
+        Renders each of the given texts like :meth:`render` does, see
+        :func:`markdown_many`. Process pools can only be used as the
+        executor with the default renderer, without renderer features, math
+        rendering or limits; otherwise the texts are rendered by this
+        instance, which can't be sent to other processes, and a thread pool
+        must be used. When instrumented, the whole batch is reported as a
+        single :class:`RenderEvent`.
+
+        :param texts: an iterable of Markdown-formatted texts
+        :param executor: an optional executor to render large batches with
+        :param overrides: Additional options which may override the defaults
+        :return: a list of :class:`flask.Markup` instances, in the order of ``texts``
+        """
+        texts = list(texts)
+        profile = self.get_profile(**overrides)
+        instrumented = self._instrumented()
+        if instrumented:
+            start = _timer()
+        rendered = {}
+        if self.cache is not None:
+            for text in texts:
+                if text not in rendered:
+                    result = _cache_get(self.cache, self._cache_key(text, profile), profile)
+                    if result is not None:
+                        rendered[text] = result
+
+        if self.renderer is None and not profile.features and not self._guarded:
+            render_chunk = functools.partial(_render_chunk, profile=profile)
+        else:
+            futures = sys.modules.get('concurrent.futures')
+            if futures is not None and isinstance(executor, futures.ProcessPoolExecutor):
+                raise ValueError('These options need a thread pool executor, not a process pool')
+            render_chunk = functools.partial(self._render_texts, profile=profile)
+        missing = _render_many([text for text in texts if text not in rendered],
+                               render_chunk, executor)
+        if self.cache is not None:
+            for text, result in missing.items():
+                _cache_set(self.cache, self._cache_key(text, profile), result, profile)
+        rendered.update(missing)
+        if instrumented:
+            self._record(start, ''.join(rendered), ''.join(rendered.values()),
+                         not missing, profile)
+        return [rendered[text] for text in texts]
+
+    def prerender(self, src, dest, jobs=None, pattern='*.md', **overrides):
+        """
+        Renders every Markdown file in the ``src`` directory tree to an HTML
+        file in the ``dest`` directory tree, with the same relative path and
+        an ``.html`` extension. This is what the ``flask misaka prerender``
+        command does.
+
+        Files are only rendered again when their contents or the rendering
+        options changed since the last run, as recorded in a manifest
+        file in ``dest``. HTML files are written atomically, so they can
+        be served while this runs. With the default renderer, files are
+        rendered by a pool of ``jobs`` processes.
+
+        :param src: the directory containing the Markdown files
+        :param dest: the directory to write the HTML files to
+        :param jobs: the number of processes to use, all cores by default
+        :param pattern: the file name pattern of the Markdown files
+        :param overrides: Additional options which may override the defaults
+        :return: the number of files rendered and of files left unchanged
+        """
+        profile = self.get_profile(**overrides)
+        fingerprint = self._fingerprint(profile)
+        manifest_path = os.path.join(dest, PRERENDER_MANIFEST)
+        try:
+            with io.open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            manifest = {}
+
+        tasks = []
+        unchanged = 0
+        for root, _, names in os.walk(src):
+            for name in fnmatch.filter(names, pattern):
+                source = os.path.join(root, name)
+                path = os.path.relpath(source, src).replace(os.sep, '/')
+                destination = os.path.join(dest, os.path.splitext(path)[0] + '.html')
+                stat = os.stat(source)
+                entry = manifest.get(path)
+                if entry is not None and entry['fingerprint'] == fingerprint and \
+                        os.path.exists(destination):
+                    if (entry['mtime'], entry['size']) == (stat.st_mtime, stat.st_size):
+                        unchanged += 1
+                        continue
+                    digest = entry['digest']
+                else:
+                    digest = None
+                if not os.path.isdir(os.path.dirname(destination)):
+                    os.makedirs(os.path.dirname(destination))
+                tasks.append((path, source, destination, digest, stat))
+
+        native = (self.renderer is None and 'math_renderer' not in profile.features and
+                  not self._guarded)
+        if native:
+            render = functools.partial(_render, profile=profile)
+        else:
+            render = functools.partial(self._render_profile, profile=profile)
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        if native and jobs > 1 and len(tasks) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(jobs) as executor:
+                futures = [executor.submit(_prerender_file, source, destination, render, digest)
+                           for _, source, destination, digest, _ in tasks]
+                results = [future.result() for future in futures]
+        else:
+            results = [_prerender_file(source, destination, render, digest)
+                       for _, source, destination, digest, _ in tasks]
+
+        rendered = 0
+        for (path, _, _, _, stat), (digest, changed) in zip(tasks, results):
+            manifest[path] = {'mtime': stat.st_mtime, 'size': stat.st_size,
+                              'digest': digest, 'fingerprint': fingerprint}
+            rendered += changed
+            unchanged += not changed
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+        _atomic_write(manifest_path, json.dumps(manifest, indent=1, sort_keys=True)
+                      .encode('utf-8'))
+        return rendered, unchanged
+
+    def render_prerendered(self, name, directory, source_directory=None, **overrides):
+        """
+        Returns the HTML file prerendered by :meth:`prerender` for the
+        Markdown file ``name``, given without its extension. If there is no
+        such HTML file, the ``.md`` file is rendered from ``source_directory``
+        instead, and if there is none either, a
+        :exc:`~werkzeug.exceptions.NotFound` error is raised.
+
+        .. code-block:: python
+
+          @app.route('/docs/<path:name>')
+          def docs(name):
+              body = md.render_prerendered(name, 'build/docs', 'docs')
+              return render_template('doc.html', body=body)
+
+        :param name: the path of the document, relative to the directories
+        :param directory: the directory containing the prerendered HTML files
+        :param source_directory: the directory containing the Markdown files
+        :param overrides: Additional options which may override the defaults
+        :return: A :class:`flask.Markup` instance representing the rendered text
+        """
+        from werkzeug.exceptions import NotFound
+        from werkzeug.security import safe_join
+
+        path = safe_join(directory, name + '.html')
+        if path is not None and os.path.isfile(path):
+            with io.open(path, encoding='utf-8') as f:
+                return Markup(f.read())
+        if source_directory is not None:
+            path = safe_join(source_directory, name + '.md')
+            if path is not None and os.path.isfile(path):
+                with io.open(path, encoding='utf-8') as f:
+                    return self.render(f.read(), **overrides)
+        raise NotFound()
+
+    def etag(self, text, **overrides):
+        """
+        Returns a strong ETag for the HTML the text renders to, computed
+        from the text and :meth:`fingerprint` without rendering it.
+
+        :param text: Markdown-formatted text
+        :param overrides: Additional options which may override the defaults
+        """
+        return _digest(self._cache_key(text, self.get_profile(**overrides)))
+
+    def render_response(self, text, max_age=None, **overrides):
+        """
+        Returns a response with the rendered text as HTML body, and an ETag
+        from :meth:`etag`. If the client already has this version, as told
+        by its ``If-None-Match`` header, an empty ``304 Not Modified``
+        response is returned without rendering the text at all:
+
+        .. code-block:: python
+
+          @app.route('/about')
+          def about():
+              return md.render_response(load_page('about'))
+
+        The response must be revalidated before it is used again, unless
+        ``max_age`` is given.
+
+        :param text: Markdown-formatted text to be rendered to HTML
+        :param max_age: how many seconds the client may use the response
+            without revalidating it
+        :param overrides: Additional options which may override the defaults
+        :return: a response of the application's response class
+        """
+        from flask import current_app, request
+
+        etag = self.etag(text, **overrides)
+        if request.method in ('GET', 'HEAD') and request.if_none_match.contains_weak(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = current_app.response_class(self.render(text, **overrides),
+                                                  mimetype='text/html')
+        response.set_etag(etag)
+        if max_age is None:
+            response.cache_control.no_cache = True
+        else:
+            response.cache_control.max_age = max_age
+        return response
+
+    def invalidate(self):
+        """
+        Empties the render cache, if there is one.
+        """
+        if self.cache is not None:
+            self.cache.invalidate()
+
+
+Changes = namedtuple('Changes', 'fragments length')
+
+
+class IncrementalRenderer(object):
+    """
+    Renders a document that changes a little at a time, like the text in a
+    live preview, by splitting it into top-level blocks and only rendering
+    the blocks that aren't in the block cache yet. Blocks next to an edit are
+    re-rendered whenever the edit changes where they start or end.
+
+    Reference link and footnote definitions are looked up in the whole
+    document. With the ``footnotes`` option, the blocks from the first one
+    referencing a footnote to the end of the document are rendered together,
+    so footnotes are numbered and listed like :meth:`Misaka.render` does.
+
+    Use one instance per document being edited; several instances can share
+    a block cache.
+
+    :param misaka: the :class:`Misaka` instance to render with
+    :param cache: a :class:`RenderCache` for the rendered blocks
+    :param overrides: Additional options which may override the defaults
+    """
+    def __init__(self, misaka, cache=None, **overrides):
+        self.misaka = misaka
+        self.profile = misaka.get_profile(**overrides)
+        self.cache = cache if cache is not None else RenderCache()
+        self.blocks = []
+
+    def _render_block(self, block):
+        key = self.misaka._cache_key(block, self.profile)
+        result = _cache_get(self.cache, key, self.profile)
+        if result is None:
+            result = self.misaka._render_profile(block, self.profile)
+            _cache_set(self.cache, key, result, self.profile)
+        return result
+
+    def _blocks(self, text):
+        blocks = list(_iter_blocks(text.splitlines(True)))
+        if self.profile.ext & EXT_FOOTNOTES:
+            first = next((index for index, block in enumerate(blocks)
+                          if _FOOTNOTE_REFERENCE_RE.search(block)), None)
+            if first is not None:
+                blocks[first:] = [''.join(blocks[first:])]
+        references = None
+        for block in blocks:
+            if ']' in block:
+                if references is None:
+                    # lines only looking like definitions render as text
+                    references = '\n'.join(line for line in _REFERENCE_RE.findall(text)
+                                           if not self._render_block(line))
+                if references:
+                    block += '\n\n' + references
+            yield block
+
+    def update(self, text):
+        """
+        Renders the new version of the document, and returns the blocks
+        whose HTML differs from the previous version.
+
+        :param text: the whole Markdown-formatted document
+        :return: a ``Changes(fragments, length)`` tuple, where ``fragments``
+            is a list of ``(index, html)`` pairs and ``length`` is the new
+            number of blocks
+        """
+        previous = self.blocks
+        self.blocks = [self._render_block(block) for block in self._blocks(text)]
+        fragments = [(index, html) for index, html in enumerate(self.blocks)
+                     if index >= len(previous) or previous[index] != html]
+        return Changes(fragments, len(self.blocks))
+
+    def render(self, text):
+        """
+        Renders the new version of the document, and returns all of it.
+
+        :param text: the whole Markdown-formatted document
+        :return: A :class:`flask.Markup` instance representing the rendered text
+        """
+        self.update(text)
+        return self.html
+
+    @property
+    def html(self):
+        """
+        The rendered HTML of the current version of the document.
+        """
+        return Markup('\n').join(block for block in self.blocks if block)
+
+
+class MarkdownField(object):
+    """
+    A descriptor which renders Markdown when it is assigned instead of when
+    it is read, for Markdown that is read much more often than it is
+    written. It stores the source, the rendered HTML and the fingerprint
+    of the options it was rendered with in three other attributes, which
+    can be ORM columns:
+
+    .. code-block:: python
+
+      class Post(db.Model):
+          body_source = db.Column(db.Text)
+          body_html = db.Column(db.Text)
+          body_fingerprint = db.Column(db.String(100))
+          body = MarkdownField(md)
+
+      post.body = "*Hello*"  # renders and stores the HTML
+      post.body              # Markup('<p><em>Hello</em></p>\n')
+
+    Reading the field returns the stored HTML, unless it was rendered with
+    different options than the current ones, as told by
+    :meth:`Misaka.fingerprint`; then it is rendered again and stored.
+
+    :param misaka: the :class:`Misaka` instance to render with
+    :param source: the attribute holding the Markdown source, by default the
+        name of the field followed by ``_source``
+    :param html: the attribute holding the rendered HTML, by default the
+        name of the field followed by ``_html``
+    :param fingerprint: the attribute holding the fingerprint, by default the
+        name of the field followed by ``_fingerprint``
+    :param overrides: Additional options which may override the defaults
+    """
+    def __init__(self, misaka, source=None, html=None, fingerprint=None, **overrides):
+        self.misaka = misaka
+        self.source = source
+        self.html = html
+        self.fingerprint = fingerprint
+        self.profile = misaka.get_profile(**overrides)
+
+    def __set_name__(self, owner, name):
+        self.source = self.source or name + '_source'
+        self.html = self.html or name + '_html'
+        self.fingerprint = self.fingerprint or name + '_fingerprint'
+
+    def __get__(self, obj, cls=None):
+        if obj is None:
+            return self
+        if getattr(obj, self.source) is None:
+            return None
+        if self.is_stale(obj):
+            self.refresh(obj)
+        return Markup(getattr(obj, self.html))
+
+    def __set__(self, obj, text):
+        setattr(obj, self.source, text)
+        self.refresh(obj)
+
+    def is_stale(self, obj):
+        """
+        Tells whether the stored HTML of ``obj`` is missing or was rendered
+        with other options than the current ones.
+        """
+        return (getattr(obj, self.html) is None or
+                getattr(obj, self.fingerprint) != self.misaka._fingerprint(self.profile))
+
+    def refresh(self, obj):
+        """
+        Renders the source of ``obj`` again and stores the result.
+        """
+        source = getattr(obj, self.source)
+        if source is None:
+            html = None
+        else:
+            html = self.misaka._render_cached(source, self.profile)
+        setattr(obj, self.html, html)
+        setattr(obj, self.fingerprint, self.misaka._fingerprint(self.profile))
+
+    def rerender_stale(self, objects):
+        """
+        Renders the stored HTML again for all the given objects for which it
+        is stale, for instance after changing the rendering options.
+        Saving the objects is up to the caller.
+
+        :param objects: an iterable of objects with this field
+        :return: the number of objects which were rendered again
         """
-        options = self.defaults
-        if overrides:
-            options = copy(options)
-            options.update(overrides)
-        return markdown(text, self.renderer, **options)
+        count = 0
+        for obj in objects:
+            if getattr(obj, self.source) is not None and self.is_stale(obj):
+                self.refresh(obj)
+                count += 1
+        return count
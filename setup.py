@@ -2,7 +2,7 @@ import sys
 import re
 from setuptools import setup, find_packages
 
-tests_require = ['Flask']
+tests_require = ['Flask', 'Pygments']
 if sys.version_info[0] < 3:
     tests_require.append('mock')
 
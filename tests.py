@@ -3,11 +3,13 @@ from flask import Flask, render_template_string
 from markupsafe import Markup
 from unittest import TestCase
 from textwrap import dedent
+import warnings
 try:
     from unittest import mock
 except ImportError:
     import mock
 
+import flask_misaka
 import misaka
 from misaka import (EXT_AUTOLINK, EXT_FENCED_CODE,  # pyflakes.ignore
                     EXT_NO_INTRA_EMPHASIS, EXT_SPACE_HEADERS, EXT_STRIKETHROUGH,
@@ -16,7 +18,10 @@ from misaka import (EXT_AUTOLINK, EXT_FENCED_CODE,  # pyflakes.ignore
                     TABLE_ALIGN_RIGHT, EXT_MATH, EXT_FOOTNOTES, EXT_UNDERLINE, EXT_MATH_EXPLICIT,
                     EXT_DISABLE_INDENTED_CODE, EXT_HIGHLIGHT, EXT_QUOTE)
 
-from flask_misaka import Misaka, markdown
+from flask_misaka import (FileSystemCache, Heading, IncrementalRenderer, MarkdownField, Misaka,
+                          Profile, RedisCache, RenderCache, RenderLimitExceeded, RenderResult,
+                          RenderStats, element_renderer,
+                          excerpt, make_profile, markdown, markdown_many)
 
 TEST_MD = "*This* ~~contains~~ ``some`` mark^(down) extensions: www.markdown.com foo_bar_baz it's"
 
@@ -320,3 +325,1360 @@ class FactoryPatternTests(TestCase):
         app2 = Flask(__name__)
         md.init_app(app2)
         self.assertIn("markdown", app2.jinja_env.filters)
+
+
+class RenderCacheTests(TestCase):
+    def test_cache_hit_skips_render(self):
+        md = Misaka(cache=True)
+        first = md.render(TEST_MD)
+        with mock.patch("flask_misaka.misaka.html") as html:
+            second = md.render(TEST_MD)
+        self.assertFalse(html.called)
+        self.assertEqual(first, second)
+        self.assertIsInstance(second, Markup)
+        self.assertEqual((md.cache.hits, md.cache.misses), (1, 1))
+
+    def test_options_are_part_of_key(self):
+        md = Misaka(cache=True)
+        plain = md.render(TEST_MD)
+        struck = md.render(TEST_MD, strikethrough=True)
+        self.assertNotEqual(plain, struck)
+        self.assertEqual(len(md.cache), 2)
+
+    def test_lru_eviction(self):
+        cache = RenderCache(max_entries=2, max_bytes=None)
+        cache.set('a', '1')
+        cache.set('b', '2')
+        cache.get('a')
+        cache.set('c', '3')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), '1')
+        self.assertEqual(cache.get('c'), '3')
+
+    def test_byte_limit(self):
+        cache = RenderCache(max_entries=None, max_bytes=200)
+        cache.set('a', 'x' * 100)
+        cache.set('b', 'y' * 100)
+        self.assertIsNone(cache.get('a'))
+        self.assertLessEqual(cache.size, 200)
+        cache.set('c', 'z' * 1000)
+        self.assertIsNone(cache.get('c'))
+
+    def test_invalidate(self):
+        md = Misaka(cache=True)
+        md.render(TEST_MD)
+        md.invalidate()
+        self.assertEqual(len(md.cache), 0)
+        self.assertEqual(md.cache.size, 0)
+
+
+class ProfileTests(TestCase):
+    def test_make_profile(self):
+        profile = make_profile(tables=True, wrap=True, smartypants=True)
+        self.assertEqual(profile, Profile(EXT_TABLES, HTML_HARD_WRAP, True))
+        self.assertEqual(hash(profile), hash(Profile(EXT_TABLES, HTML_HARD_WRAP, True)))
+
+    def test_defaults_resolved_once(self):
+        md = Misaka(tables=True)
+        with mock.patch("flask_misaka.make_flags") as make_flags:
+            md.render(TEST_MD)
+        self.assertFalse(make_flags.called)
+
+    def test_overrides_memoized(self):
+        md = Misaka(tables=True)
+        profile = md.get_profile(autolink=True)
+        self.assertIs(md.get_profile(autolink=True), profile)
+        self.assertEqual(profile.ext, EXT_TABLES | EXT_AUTOLINK)
+        self.assertIs(md.get_profile(), md.profile)
+
+    def test_changed_defaults_ignored(self):
+        md = Misaka(autolink=True)
+        md.defaults['autolink'] = False
+        self.assertIn('<a href', md.render('http://x.com'))
+        self.assertIn('<a href', md.render('http://x.com', escape=False))
+
+    def test_unknown_option_warns(self):
+        with mock.patch("flask_misaka.warnings.warn") as warn:
+            Misaka(fireworks=True)
+        self.assertTrue(warn.called)
+        with mock.patch("flask_misaka.warnings.warn") as warn:
+            Misaka(intra_emphasis=False, html=False, smartypants=True)
+        self.assertFalse(warn.called)
+
+
+class ParserReuseTests(TestCase):
+    test_md = '![Alt text](/img.jpg "Title")'
+
+    class CustomRenderer(misaka.HtmlRenderer):
+        def image(self, link, title, alt_text):
+            return '<img src="{0}">'.format(link)
+
+    def test_instance_parser_reused(self):
+        md = Misaka(None, self.CustomRenderer())
+        with mock.patch("flask_misaka.misaka.Markdown", side_effect=misaka.Markdown) as Markdown:
+            first = md.render(self.test_md)
+            second = md.render(self.test_md)
+        self.assertEqual(Markdown.call_count, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(str(first), '<p><img src="/img.jpg"></p>\n')
+
+    def test_factory_parser_per_thread(self):
+        import threading
+        md = Misaka(None, self.CustomRenderer)
+        results = []
+
+        def target():
+            results.append(md.render(self.test_md))
+            results.append(md.render(self.test_md))
+
+        with mock.patch("flask_misaka.misaka.Markdown", side_effect=misaka.Markdown) as Markdown:
+            threads = [threading.Thread(target=target) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(Markdown.call_count, 3)
+        self.assertEqual(len(set(results)), 1)
+        self.assertEqual(str(results[0]), '<p><img src="/img.jpg"></p>\n')
+
+
+class RenderManyTests(TestCase):
+    texts = ["*one*", "**two**", "*one*", "three"]
+
+    def test_markdown_many(self):
+        with mock.patch("flask_misaka.misaka.html", side_effect=misaka.html) as html:
+            results = markdown_many(self.texts, strikethrough=True)
+        self.assertEqual(html.call_count, 3)
+        self.assertEqual(results, [markdown(text, strikethrough=True) for text in self.texts])
+        for result in results:
+            self.assertIsInstance(result, Markup)
+
+    def test_render_many_with_executor(self):
+        from concurrent.futures import ThreadPoolExecutor
+        texts = ["item %d *%d*" % (i % 50, i) for i in range(200)]
+        md = Misaka(cache=True)
+        with ThreadPoolExecutor(4) as executor:
+            results = md.render_many(texts, executor=executor)
+        self.assertEqual(results, [md.render(text) for text in texts])
+        self.assertEqual(len(md.cache), 200)
+
+    def test_render_many_uses_cache(self):
+        md = Misaka(cache=True)
+        md.render("*one*")
+        with mock.patch("flask_misaka.misaka.html", side_effect=misaka.html) as html:
+            results = md.render_many(self.texts)
+        self.assertEqual(html.call_count, 2)
+        self.assertEqual(results[0], md.render("*one*"))
+
+    def test_custom_renderer_with_executor(self):
+        self.assertRaises(ValueError, markdown_many, self.texts,
+                          misaka.HtmlRenderer(), executor=object())
+
+    def test_features_with_process_pool(self):
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(1) as executor:
+            self.assertRaises(ValueError, Misaka(toc=True).render_many, self.texts,
+                              executor=executor)
+            self.assertEqual(Misaka().render_many(self.texts, executor=executor),
+                             [markdown(text) for text in self.texts])
+
+
+class RenderStreamTests(TestCase):
+    doc = dedent("""
+        # Title
+
+        A paragraph
+        spanning lines.
+
+        - one
+        - two
+
+        - three
+
+        ```
+        code
+
+        more code
+        ```
+
+        > quoted
+
+        > still quoted
+
+        | a | b |
+        |---|---|
+        | c | d |
+
+        The end.
+    """)
+
+    def test_matches_render(self):
+        md = Misaka(fenced_code=True, tables=True)
+        chunks = list(md.render_stream(self.doc, chunk_size=1))
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertIsInstance(chunk, Markup)
+        self.assertEqual(''.join(chunks), md.render(self.doc))
+        # blank lines inside raw HTML blocks don't end them
+        for doc in ('<div><span>a</span>\n\nb\n\n</div>\n', '<div>\n<p>x</p>\n\ny\n\n</div>\n',
+                    '<!-- a\n\n-->\n<div>\n\n</div>\n\n*b*\n'):
+            self.assertEqual(''.join(md.render_stream(doc, chunk_size=1)), md.render(doc))
+
+    def test_file_source(self):
+        from io import StringIO
+        md = Misaka(fenced_code=True, tables=True)
+        result = ''.join(md.render_stream(StringIO(self.doc)))
+        self.assertEqual(result, md.render(self.doc))
+
+    def test_fences_kept_together(self):
+        from flask_misaka import _iter_blocks
+        blocks = list(_iter_blocks(self.doc.splitlines(True)))
+        self.assertTrue(any("```\ncode\n\nmore code\n```\n" in block for block in blocks))
+
+
+class IncrementalRendererTests(TestCase):
+    doc = dedent("""
+        # Title
+
+        First paragraph.
+
+        Second paragraph.
+
+        - a list
+        - of items
+    """)
+
+    def test_render_matches(self):
+        md = Misaka()
+        renderer = IncrementalRenderer(md)
+        self.assertEqual(renderer.render(self.doc), md.render(self.doc))
+        self.assertIsInstance(renderer.html, Markup)
+
+    def test_only_changed_blocks_rendered(self):
+        md = Misaka()
+        renderer = IncrementalRenderer(md)
+        changes = renderer.update(self.doc)
+        self.assertEqual(len(changes.fragments), changes.length)
+
+        edited = self.doc.replace("Second", "Edited")
+        with mock.patch("flask_misaka.misaka.html", side_effect=misaka.html) as html:
+            changes = renderer.update(edited)
+        self.assertEqual(html.call_count, 1)
+        self.assertEqual(len(changes.fragments), 1)
+        index, fragment = changes.fragments[0]
+        self.assertEqual(fragment, "<p>Edited paragraph.</p>\n")
+        self.assertEqual(renderer.html, md.render(edited))
+
+    def test_html_blocks(self):
+        md = Misaka()
+        for doc in ('<div><span>a</span>\n\nb\n\n</div>\n', '<div>\n<p>x</p>\n\ny\n\n</div>\n'):
+            renderer = IncrementalRenderer(md)
+            self.assertEqual(renderer.render(doc), md.render(doc))
+            self.assertEqual(renderer.update(doc.replace('\n\n</div>', '\n\nc\n\n</div>')).length, 1)
+
+    def test_references(self):
+        doc = 'See [docs][1] and note[^a].\n\nMore.\n\n[1]: http://x\n[^a]: The note.\n'
+        for md in (Misaka(), Misaka(footnotes=True)):
+            self.assertEqual(IncrementalRenderer(md).render(doc), md.render(doc))
+        renderer = IncrementalRenderer(Misaka(footnotes=True))
+        renderer.update(doc)
+        self.assertEqual(renderer.update(doc.replace('More', 'Less')).length, 1)
+        renderer = IncrementalRenderer(Misaka())
+        renderer.update(doc)
+        self.assertEqual(renderer.update(doc.replace('More', 'Less')).fragments,
+                         [(1, '<p>Less.</p>\n')])
+
+    def test_removed_blocks(self):
+        renderer = IncrementalRenderer(Misaka())
+        renderer.update(self.doc)
+        changes = renderer.update("# Title\n")
+        self.assertEqual(changes.fragments, [])
+        self.assertEqual(changes.length, 1)
+
+
+class RenderAsyncTests(TestCase):
+    def run_async(self, coro):
+        import asyncio
+        return asyncio.run(coro)
+
+    def test_small_text_inline(self):
+        md = Misaka(strikethrough=True)
+
+        async def main():
+            return await md.render_async(TEST_MD)
+
+        result = self.run_async(main())
+        self.assertIsInstance(result, Markup)
+        self.assertEqual(result, md.render(TEST_MD))
+        self.assertIsNone(md.async_executor)
+
+    def test_large_text_offloaded(self):
+        from concurrent.futures import ThreadPoolExecutor
+        import threading
+        executor = ThreadPoolExecutor(1)
+        md = Misaka(async_threshold=10, async_executor=executor)
+        threads = []
+        render = misaka.html
+
+        def html(*args, **kwargs):
+            threads.append(threading.current_thread())
+            return render(*args, **kwargs)
+
+        async def main():
+            return await md.render_async(TEST_MD)
+
+        with mock.patch("flask_misaka.misaka.html", side_effect=html):
+            result = self.run_async(main())
+        executor.shutdown()
+        self.assertEqual(result, markdown(TEST_MD))
+        self.assertNotEqual(threads, [threading.current_thread()])
+
+    def test_async_template_filter(self):
+        from jinja2 import Environment
+        env = Environment(enable_async=True, autoescape=True)
+        app = mock.Mock(jinja_env=env)
+        md = Misaka(app, async_threshold=0)
+        self.assertEqual(env.filters['markdown'], md.render_async)
+        template = env.from_string('{{ s|markdown }}')
+        result = self.run_async(template.render_async(s="*hi*"))
+        self.assertEqual(result, '<p><em>hi</em></p>\n')
+
+
+class CacheBackendTests(TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_memory_timeout(self):
+        cache = RenderCache()
+        cache.set('a', '1', timeout=60)
+        self.assertEqual(cache.get('a'), '1')
+        with mock.patch("flask_misaka.time.time", return_value=10 ** 11):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.size, 0)
+
+    def test_file_system_cache(self):
+        md = Misaka(cache=FileSystemCache(self.directory))
+        first = md.render(TEST_MD)
+        other = Misaka(cache=FileSystemCache(self.directory))
+        with mock.patch("flask_misaka.misaka.html") as html:
+            second = other.render(TEST_MD)
+        self.assertFalse(html.called)
+        self.assertIsInstance(second, Markup)
+        self.assertEqual(first, second)
+        self.assertEqual(other.cache.hits, 1)
+        other.invalidate()
+        self.assertIsNone(md.cache.get(md._cache_key(TEST_MD, md.profile)))
+
+    def test_shared_cache_renderer_instance(self):
+        self.assertRaises(ValueError, Misaka, renderer=misaka.HtmlRenderer(HTML_ESCAPE),
+                          cache=FileSystemCache(self.directory))
+        Misaka(renderer=misaka.HtmlRenderer(HTML_ESCAPE), cache=True)
+        Misaka(renderer=misaka.HtmlRenderer, cache=FileSystemCache(self.directory))
+
+    def test_file_system_cache_pruning(self):
+        import os
+        cache = FileSystemCache(self.directory, max_entries=3)
+        for i in range(5):
+            cache.set('key%d' % i, 'value')
+            os.utime(cache._path('key%d' % i), (i, i))
+        cache.prune()
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+        self.assertIsNone(cache.get('key0'))
+        self.assertEqual(cache.get('key4'), 'value')
+
+    def test_file_system_cache_timeout(self):
+        cache = FileSystemCache(self.directory)
+        cache.set('a', 'value', timeout=60)
+        self.assertEqual(cache.get('a'), 'value')
+        with mock.patch("flask_misaka.time.time", return_value=10 ** 11):
+            self.assertIsNone(cache.get('a'))
+
+    def test_file_system_cache_malformed(self):
+        cache = FileSystemCache(self.directory)
+        with open(cache._path('a'), 'wb') as f:
+            f.write(b'garbage\nvalue')
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.misses, 1)
+
+    def test_redis_cache(self):
+        server = FakeRedisServer()
+        try:
+            cache = RedisCache(port=server.port, prefix='test:')
+            md = Misaka(cache=cache)
+            first = md.render(TEST_MD)
+            self.assertEqual(len(server.data), 1)
+            with mock.patch("flask_misaka.misaka.html") as html:
+                second = md.render(TEST_MD)
+            self.assertFalse(html.called)
+            self.assertIsInstance(second, Markup)
+            self.assertEqual(first, second)
+
+            cache.set('other', 'value', timeout=10)
+            self.assertEqual(server.timeouts[b'test:other'], b'10')
+            server.data[b'unrelated'] = b'x'
+            cache.invalidate()
+            self.assertEqual(list(server.data), [b'unrelated'])
+        finally:
+            server.close()
+
+    def test_redis_cache_unavailable(self):
+        server = FakeRedisServer()
+        server.close()
+        md = Misaka(cache=RedisCache(port=server.port))
+        self.assertEqual(md.render(TEST_MD), markdown(TEST_MD))
+        self.assertEqual(md.cache.misses, 1)
+        md.invalidate()
+
+    def test_redis_cache_error_reply(self):
+        server = FakeRedisServer()
+        server.error = b"OOM command not allowed when used memory > 'maxmemory'."
+        try:
+            md = Misaka(cache=RedisCache(port=server.port))
+            self.assertEqual(md.render('*hi*'), markdown('*hi*'))
+            self.assertEqual(md.cache.misses, 1)
+            md.invalidate()
+        finally:
+            server.close()
+
+
+class FakeRedisServer(object):
+    "A stand-in for a Redis server, supporting the commands RedisCache needs"
+
+    def __init__(self):
+        import socket
+        import threading
+        self.data = {}
+        self.timeouts = {}
+        self.error = None
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self.sock.close()
+
+    def serve(self):
+        import threading
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        import fnmatch
+        reader = conn.makefile('rb')
+        while True:
+            line = reader.readline()
+            if not line:
+                return
+            args = []
+            for _ in range(int(line[1:])):
+                length = int(reader.readline()[1:])
+                args.append(reader.read(length + 2)[:-2])
+            command = args[0].upper()
+            if self.error is not None:
+                reply = b'-%s\r\n' % self.error
+            elif command == b'GET':
+                value = self.data.get(args[1])
+                reply = b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value)
+            elif command == b'SET':
+                self.data[args[1]] = args[2]
+                if len(args) > 3:
+                    self.timeouts[args[1]] = args[4]
+                reply = b'+OK\r\n'
+            elif command == b'SCAN':
+                pattern = args[3].decode('utf-8').replace('\\*', '*')
+                keys = [key for key in self.data if fnmatch.fnmatch(key.decode('utf-8'), pattern)]
+                reply = b'*2\r\n$1\r\n0\r\n*%d\r\n' % len(keys) + b''.join(
+                    b'$%d\r\n%s\r\n' % (len(key), key) for key in keys)
+            elif command == b'DEL':
+                for key in args[1:]:
+                    self.data.pop(key, None)
+                reply = b':%d\r\n' % (len(args) - 1)
+            else:
+                reply = b'-ERR unknown command\r\n'
+            conn.sendall(reply)
+
+
+class InstrumentationTests(TestCase):
+    def test_not_instrumented_by_default(self):
+        md = Misaka()
+        with mock.patch("flask_misaka.Misaka._record") as record:
+            md.render(TEST_MD)
+        self.assertFalse(record.called)
+
+    def test_stats(self):
+        md = Misaka(cache=True, stats=True)
+        md.render(TEST_MD)
+        md.render(TEST_MD)
+        stats = md.stats.as_dict()
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['cache_hits'], 1)
+        self.assertEqual(stats['input_bytes'], 2 * len(TEST_MD.encode('utf-8')))
+        self.assertEqual(stats['output_bytes'], 2 * len(markdown(TEST_MD).encode('utf-8')))
+        self.assertEqual(sum(count for _, count in stats['histogram']), 2)
+        self.assertEqual(stats['profiles'], {md.profile.fingerprint: 2})
+        self.assertIsNotNone(stats['p99'])
+        md.stats.reset()
+        self.assertEqual(md.stats.count, 0)
+
+    def test_percentile(self):
+        from flask_misaka import RenderEvent
+        stats = RenderStats(buckets=(0.1, 1.0))
+        profile = make_profile()
+        for duration in [0.05] * 98 + [0.5, 2.0]:
+            stats.record(RenderEvent(duration, 0, 0, False, profile))
+        self.assertEqual(stats.percentile(50), 0.1)
+        self.assertEqual(stats.percentile(99), 1.0)
+        self.assertEqual(stats.percentile(100), 2.0)
+
+    def test_callback_and_signal(self):
+        from flask_misaka import markdown_rendered
+        events = []
+        signalled = []
+
+        def receiver(sender, event):
+            signalled.append((sender, event))
+
+        md = Misaka(on_render=events.append, tables=True)
+        markdown_rendered.connect(receiver)
+        try:
+            md.render(TEST_MD)
+        finally:
+            markdown_rendered.disconnect(receiver)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].profile, md.profile)
+        self.assertFalse(events[0].cache_hit)
+        self.assertGreaterEqual(events[0].duration, 0)
+        self.assertEqual(signalled, [(md, events[0])])
+
+    def test_render_many_single_event(self):
+        events = []
+        md = Misaka(on_render=events.append)
+        md.render_many(["*a*", "*b*", "*a*"])
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].input_size, 6)
+
+
+class FusedSmartypantsTests(TestCase):
+    texts = [
+        "Don't \"quote\" me -- or --- anything... (c) 1/2",
+        "*\"Nested\"* `code 'here'` and <b>'html'</b>",
+        "",
+    ]
+
+    def test_single_pass_matches_two_passes(self):
+        for text in self.texts:
+            expected = misaka.smartypants(misaka.html(text, extensions=EXT_QUOTE))
+            with mock.patch("flask_misaka.misaka.smartypants") as smartypants:
+                result = markdown(text, quote=True, smartypants=True)
+            self.assertFalse(smartypants.called)
+            self.assertIsInstance(result, Markup)
+            self.assertEqual(result, expected)
+
+    def test_custom_renderer(self):
+        class CustomRenderer(misaka.HtmlRenderer):
+            def emphasis(self, content):
+                return '<i>%s</i>' % content
+
+        text = self.texts[1]
+        expected = misaka.smartypants(misaka.Markdown(CustomRenderer())(text))
+        md = Misaka(None, CustomRenderer(), smartypants=True)
+        self.assertEqual(md.render(text), expected)
+
+
+class MarkdownFieldTests(TestCase):
+    def make_model(self, md, **overrides):
+        class Post(object):
+            body_source = None
+            body_html = None
+            body_fingerprint = None
+            body = MarkdownField(md, **overrides)
+        return Post
+
+    def test_render_on_write(self):
+        md = Misaka(strikethrough=True)
+        post = self.make_model(md)()
+        self.assertIsNone(post.body)
+        post.body = TEST_MD
+        self.assertEqual(post.body_source, TEST_MD)
+        self.assertEqual(post.body_html, markdown(TEST_MD, strikethrough=True))
+        self.assertEqual(post.body_fingerprint, md.fingerprint())
+        with mock.patch("flask_misaka.misaka.html") as html:
+            result = post.body
+        self.assertFalse(html.called)
+        self.assertIsInstance(result, Markup)
+        self.assertEqual(result, post.body_html)
+
+    def test_stale_rerendered_on_read(self):
+        post = self.make_model(Misaka())()
+        post.body_source = TEST_MD
+        post.body_html = "<p>old</p>"
+        post.body_fingerprint = "old"
+        self.assertEqual(post.body, markdown(TEST_MD))
+        self.assertNotEqual(post.body_fingerprint, "old")
+
+    def test_rerender_stale(self):
+        old = Misaka()
+        new = Misaka(strikethrough=True)
+        Post = self.make_model(old)
+        posts = [Post() for _ in range(3)]
+        for post in posts:
+            post.body = TEST_MD
+        posts.append(Post())
+        field = Post.__dict__['body']
+        self.assertEqual(field.rerender_stale(posts), 0)
+        field.misaka = new
+        field.profile = new.profile
+        self.assertEqual(field.rerender_stale(posts), 3)
+        self.assertEqual(posts[0].body_html, markdown(TEST_MD, strikethrough=True))
+        self.assertIsNone(posts[3].body_html)
+
+
+class PrerenderTests(TestCase):
+    def setUp(self):
+        import os
+        import tempfile
+        self.src = tempfile.mkdtemp()
+        self.dest = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.src, 'guide'))
+        self.write('index.md', TEST_MD)
+        self.write('guide/install.md', "# Install\n\nRun *pip*.")
+        self.write('notes.txt', "not markdown")
+        self.app = Flask(__name__)
+        self.md = Misaka(self.app, strikethrough=True)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.src)
+        shutil.rmtree(self.dest)
+
+    def write(self, name, text):
+        import io
+        import os
+        with io.open(os.path.join(self.src, name), 'w', encoding='utf-8') as f:
+            f.write(text)
+
+    def read(self, name):
+        import io
+        import os
+        with io.open(os.path.join(self.dest, name), encoding='utf-8') as f:
+            return f.read()
+
+    def test_command(self):
+        import os
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['misaka', 'prerender', self.src, self.dest, '-j', '2'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Rendered 2 files, 0 unchanged.', result.output)
+        self.assertEqual(self.read('index.html'), markdown(TEST_MD, strikethrough=True))
+        self.assertEqual(self.read('guide/install.html'), markdown("# Install\n\nRun *pip*."))
+        self.assertFalse(os.path.exists(os.path.join(self.dest, 'notes.html')))
+
+        result = runner.invoke(args=['misaka', 'prerender', self.src, self.dest])
+        self.assertIn('Rendered 0 files, 2 unchanged.', result.output)
+
+    def test_changes(self):
+        import os
+        self.md.prerender(self.src, self.dest, jobs=1)
+        # touched, but the same contents
+        os.utime(os.path.join(self.src, 'index.md'), (1, 1))
+        self.write('guide/install.md', "# Installation")
+        self.assertEqual(self.md.prerender(self.src, self.dest, jobs=1), (1, 1))
+        self.assertEqual(self.read('guide/install.html'), "<h1>Installation</h1>\n")
+        # other options render everything again
+        self.assertEqual(self.md.prerender(self.src, self.dest, jobs=1, tables=True), (2, 0))
+
+    def test_render_prerendered(self):
+        import os
+        from werkzeug.exceptions import NotFound
+        self.md.prerender(self.src, self.dest, jobs=1)
+        with open(os.path.join(self.dest, 'index.html'), 'w') as f:
+            f.write('<p>prerendered</p>')
+        result = self.md.render_prerendered('index', self.dest, self.src)
+        self.assertIsInstance(result, Markup)
+        self.assertEqual(result, '<p>prerendered</p>')
+
+        self.write('new.md', "*new*")
+        self.assertEqual(self.md.render_prerendered('new', self.dest, self.src),
+                         "<p><em>new</em></p>\n")
+        self.assertRaises(NotFound, self.md.render_prerendered, 'missing', self.dest, self.src)
+        self.assertRaises(NotFound, self.md.render_prerendered, '../index', self.dest)
+
+
+class TocTests(TestCase):
+    doc = "# Intro *here*\n\nText.\n\n## Details &amp; more\n\n## Details & more\n"
+
+    def test_headings(self):
+        result = markdown(self.doc, toc=True)
+        self.assertIsInstance(result, RenderResult)
+        self.assertEqual(result.headings, [
+            Heading(1, 'Intro here', 'intro-here'),
+            Heading(2, 'Details & more', 'details-more'),
+            Heading(2, 'Details & more', 'details-more-2'),
+        ])
+        self.assertIn('<h1 id="intro-here">Intro <em>here</em></h1>', result)
+        self.assertIn('<h2 id="details-more-2">', result)
+
+    def test_single_pass(self):
+        md = Misaka(toc=True)
+        md.render(self.doc)
+        with mock.patch("flask_misaka.misaka.html") as html:
+            result = md.render(self.doc)
+        self.assertFalse(html.called)
+        self.assertEqual(len(result.headings), 3)
+        self.assertEqual(md.render("# Other").headings, [Heading(1, 'Other', 'other')])
+
+    def test_without_toc(self):
+        self.assertNotIsInstance(Misaka().render(self.doc), RenderResult)
+        self.assertNotIn('id=', Misaka(toc=True).render(self.doc, toc=False))
+
+    def test_cached(self):
+        import tempfile
+        import shutil
+        directory = tempfile.mkdtemp()
+        try:
+            md = Misaka(cache=FileSystemCache(directory), toc=True, smartypants=True)
+            first = md.render(self.doc)
+            second = md.render(self.doc)
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(md.cache.hits, 1)
+        self.assertIsInstance(second, RenderResult)
+        self.assertEqual(first, second)
+        self.assertEqual(first.headings, second.headings)
+
+    def test_renderer_class(self):
+        class CustomRenderer(misaka.HtmlRenderer):
+            def emphasis(self, content):
+                return '<i>%s</i>' % content
+
+        result = Misaka(None, CustomRenderer, toc=True).render(self.doc)
+        self.assertIn('<h1 id="intro-here">Intro <i>here</i></h1>', result)
+        self.assertRaises(ValueError, Misaka(None, CustomRenderer(), toc=True).render, self.doc)
+
+    def test_renderer_header(self):
+        class CustomRenderer(misaka.HtmlRenderer):
+            def header(self, content, level):
+                return '<h%d class="title">%s</h%d>\n' % (level, content, level)
+
+        self.assertEqual(Misaka(None, CustomRenderer, toc=True).render('# T'),
+                         '<h1 id="t" class="title">T</h1>\n')
+        self.assertEqual(Misaka(elements={'header': {'class': 'title'}}, toc=True).render('# T'),
+                         '<h1 id="t" class="title">T</h1>\n')
+
+
+class CollectTests(TestCase):
+    doc = dedent("""
+        See <http://example.com/a?b=c&d> or mail foo@example.com, and
+        read [the docs](/docs "Docs") with ![a logo](/logo.png).
+
+        ```python
+        print("hi")
+        ```
+
+        ```js
+        x = 1
+        ```
+
+        ```python
+        pass
+        ```
+
+        Footnotes[^1] are counted[^2].
+
+        [^1]: One.
+        [^2]: Two.
+    """)
+    options = dict(autolink=True, fenced_code=True, footnotes=True)
+
+    def test_collect(self):
+        result = markdown(self.doc, collect=True, **self.options)
+        self.assertIsInstance(result, RenderResult)
+        self.assertEqual(result.links, ['http://example.com/a?b=c&d', 'mailto:foo@example.com',
+                                        '/docs'])
+        self.assertEqual(result.images, ['/logo.png'])
+        self.assertEqual(result.code_languages, ['python', 'js'])
+        self.assertEqual(result.footnotes, 2)
+        self.assertEqual(result.word_count, 14)
+
+    def test_same_html(self):
+        import re
+        for xhtml in (False, True):
+            expected = markdown(self.doc, xhtml=xhtml, **self.options)
+            result = markdown(self.doc, collect=True, xhtml=xhtml, **self.options)
+            # Python callbacks can't separate blocks with newlines like Hoedown does
+            self.assertEqual(re.sub(r'\n+', '\n', result), re.sub(r'\n+', '\n', expected))
+
+    def test_with_toc(self):
+        result = Misaka(collect=True, toc=True).render("# Title\n\n[link](/x)")
+        self.assertEqual(result.headings, [Heading(1, 'Title', 'title')])
+        self.assertEqual(result.links, ['/x'])
+
+
+class ExcerptTests(TestCase):
+    def test_plain_text(self):
+        text = dedent("""
+            # Title
+
+            Some *emphasis*, <b>html</b>, `code` &amp; a [link][1] to
+            <http://example.com>. ![A picture](/a.png)![](/b.png)[^1]
+
+            [1]: /x
+            [^1]: A note.
+        """)
+        self.assertEqual(excerpt(text, footnotes=True, autolink=True),
+                         'Title Some emphasis, html, code &amp; a link to '
+                         'http://example.com. A picture')
+
+    def test_truncate(self):
+        result = excerpt('One two, three four.\n\nFive six.', 17)
+        self.assertEqual(result, 'One two, three\u2026')
+        self.assertLessEqual(len(result), 17)
+        self.assertEqual(excerpt('One two', 7), 'One two')
+        self.assertEqual(excerpt('Abcdefghijkl', 6, ellipsis='...'), 'Abc...')
+
+    def test_escaped(self):
+        result = excerpt('Use `<script>` & **stuff**')
+        self.assertIsInstance(result, Markup)
+        self.assertEqual(result, 'Use &lt;script&gt; &amp; stuff')
+
+    def test_renders_only_beginning(self):
+        text = '\n\n'.join('Paragraph number %d.' % i for i in range(1000))
+        with mock.patch('flask_misaka.PlainTextRenderer.paragraph',
+                        side_effect=lambda self, content: content + '\n\n',
+                        autospec=True) as paragraph:
+            result = excerpt(text, 50)
+        self.assertEqual(result, 'Paragraph number 0. Paragraph number 1. Paragraph\u2026')
+        self.assertLess(paragraph.call_count, 10)
+
+    def test_filter(self):
+        app = Flask(__name__)
+        Misaka(app, cache=True)
+        with app.app_context():
+            result = render_template_string('{{ text|markdown_excerpt(11) }}',
+                                            text='*Hello* world & more')
+        self.assertEqual(result, 'Hello\u2026')
+
+    def test_cached(self):
+        md = Misaka(cache=True)
+        self.assertEqual(md.excerpt('Hello <world>', 50), 'Hello')
+        with mock.patch('flask_misaka._excerpt') as _excerpt:
+            self.assertEqual(md.excerpt('Hello <world>', 50), 'Hello')
+        self.assertFalse(_excerpt.called)
+
+
+class HighlightTests(TestCase):
+    doc = "```python\nx = 1\n```\n\n```no-such-language\ny\n```\n\n    z\n"
+
+    def setUp(self):
+        flask_misaka._highlight_cache.clear()
+
+    def test_highlight(self):
+        result = markdown(self.doc, fenced_code=True, highlight_code=True)
+        self.assertIn('<div class="highlight"><pre>', result)
+        self.assertIn('<span class="mi">1</span>', result)
+        self.assertIn('<pre><code class="language-no-such-language">y\n</code></pre>', result)
+        self.assertIn('<pre><code>z\n</code></pre>', result)
+        self.assertNotIn('highlight', markdown(self.doc, fenced_code=True))
+
+    def test_cached_blocks(self):
+        md = Misaka(fenced_code=True, highlight_code=True)
+        expected = md.render(self.doc)
+        # unknown languages aren't cached, as they come from the text
+        self.assertIn('python', flask_misaka._lexers)
+        self.assertNotIn('no-such-language', flask_misaka._lexers)
+        with mock.patch('flask_misaka._get_lexer', return_value=None) as get_lexer:
+            self.assertTrue(md.render("Changed\n\n" + self.doc).endswith(expected))
+        # only the block with an unknown language needs a lexer lookup
+        get_lexer.assert_called_once_with('no-such-language')
+
+    def test_bounded_cache(self):
+        with mock.patch('flask_misaka.HIGHLIGHT_CACHE_SIZE', 2):
+            for i in range(5):
+                markdown("```python\nx = %d\n```" % i, fenced_code=True, highlight_code=True)
+        self.assertEqual(len(flask_misaka._highlight_cache), 2)
+
+    def test_with_collect(self):
+        result = markdown(self.doc, fenced_code=True, highlight_code=True, collect=True)
+        self.assertEqual(result.code_languages, ['python', 'no-such-language'])
+        self.assertIn('<span class="mi">1</span>', result)
+
+
+class MathRendererTests(TestCase):
+    doc = "Inline $$a+b$$ and $$c$$.\n\n$$\nx < 1\n$$\n"
+
+    def test_math_renderer(self):
+        backend = mock.Mock(side_effect=lambda tex, display: '<m d="%d">%s</m>' % (display, tex))
+        md = Misaka(math=True, math_renderer=backend)
+        result = md.render(self.doc)
+        self.assertEqual(result, '<p>Inline <m d="0">a+b</m> and <m d="0">c</m>.</p>\n\n'
+                                 '<p><m d="1">\nx < 1\n</m></p>\n')
+        self.assertNotIsInstance(result, RenderResult)
+        self.assertEqual(backend.call_count, 3)
+        md.render("$$c$$ again")
+        self.assertEqual(backend.call_count, 3)
+
+    def test_batch(self):
+        backend = mock.Mock(side_effect=lambda formulas: ['<m>%s</m>' % tex for tex, _ in formulas])
+        md = Misaka(math=True, math_renderer=backend, math_batch=True)
+        md.render(self.doc)
+        backend.assert_called_once_with([('a+b', False), ('c', False), ('\nx < 1\n', True)])
+        self.assertEqual(md.render("$$c$$, $$d$$ and $$c$$"),
+                         '<p><m>c</m>, <m>d</m> and <m>c</m></p>\n')
+        self.assertEqual(backend.call_args, mock.call([('d', False)]))
+
+    def test_fallback(self):
+        md = Misaka(math=True, math_renderer=lambda tex, display: None)
+        self.assertEqual(md.render(self.doc), markdown(self.doc, math=True))
+
+    def test_without_math(self):
+        backend = mock.Mock()
+        md = Misaka(math_renderer=backend)
+        self.assertEqual(md.render(self.doc), markdown(self.doc))
+        self.assertEqual(md.fingerprint(), Misaka().fingerprint())
+        self.assertNotEqual(md.fingerprint(math=True), Misaka().fingerprint(math=True))
+        self.assertFalse(backend.called)
+
+    def test_placeholder_in_text(self):
+        md = Misaka(math=True, math_renderer=lambda tex, display: '<m>%s</m>' % tex)
+        self.assertEqual(md.render('$$x$$ and \x020\x03'), '<p><m>x</m> and \x020\x03</p>\n')
+        self.assertEqual(md.render('$$x$$ \x029\x03'), '<p><m>x</m> \x029\x03</p>\n')
+
+    def test_shared_cache(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for toc in (False, True):
+            md = Misaka(math=True, toc=toc, cache=FileSystemCache(directory),
+                        math_renderer=lambda tex, display: '<m>%s</m>' % tex)
+            first = md.render("# Title\n\n$$x$$")
+            second = md.render("# Title\n\n$$x$$")
+            self.assertEqual(md.cache.hits, 1)
+            self.assertEqual(first, second)
+            self.assertIn('<p><m>x</m></p>', second)
+
+    def test_with_toc(self):
+        md = Misaka(math=True, toc=True, math_renderer=lambda tex, display: '<m/>')
+        result = md.render("# Title\n\n$$x$$")
+        self.assertEqual(result.headings, [Heading(1, 'Title', 'title')])
+        self.assertFalse(hasattr(result, 'math'))
+        self.assertIn('<p><m/></p>', result)
+
+
+class RenderResponseTests(TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.md = Misaka(self.app)
+
+        @self.app.route('/')
+        def index():
+            return self.md.render_response('# Hello')
+
+        @self.app.route('/cached')
+        def cached():
+            return self.md.render_response('# Hello', max_age=60, autolink=True)
+
+    def test_response(self):
+        response = self.app.test_client().get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/html')
+        self.assertEqual(response.get_data(as_text=True), '<h1>Hello</h1>\n')
+        self.assertEqual(response.headers['ETag'], '"%s"' % self.md.etag('# Hello'))
+        self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+        self.assertEqual(self.app.test_client().get('/cached').headers['Cache-Control'],
+                         'max-age=60')
+
+    def test_not_modified(self):
+        client = self.app.test_client()
+        etag = client.get('/').headers['ETag']
+        with mock.patch("flask_misaka.misaka.html") as html:
+            response = client.get('/', headers={'If-None-Match': etag})
+        self.assertFalse(html.called)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        self.assertEqual(response.headers['ETag'], etag)
+
+        # the ETag depends on the options too
+        response = client.get('/cached', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_etag(self):
+        self.assertEqual(self.md.etag('a'), self.md.etag('a'))
+        self.assertNotEqual(self.md.etag('a'), self.md.etag('b'))
+        self.assertNotEqual(self.md.etag('a'), self.md.etag('a', smartypants=True))
+
+
+class SlowRenderer(misaka.HtmlRenderer):
+    def paragraph(self, content):
+        if content == 'slow':
+            import time
+            time.sleep(10)
+        return '<p>%s</p>\n' % content
+
+
+class LimitTests(TestCase):
+    def test_input_size(self):
+        md = Misaka(max_input_size=10)
+        self.assertEqual(md.render('short'), '<p>short</p>\n')
+        # the limit is in bytes
+        self.assertRaises(RenderLimitExceeded, md.render, '\u00e9' * 6)
+        self.assertEqual(Misaka(max_input_size=10, on_limit='escape').render('<b>' * 4),
+                         '<pre>&lt;b&gt;&lt;b&gt;&lt;b&gt;&lt;b&gt;</pre>\n')
+        self.assertEqual(Misaka(max_input_size=12, on_limit='truncate').render('One\nTwo\nThree\n'),
+                         '<p>One\nTwo</p>\n')
+
+    def test_render_many(self):
+        md = Misaka(max_input_size=10, on_limit='escape')
+        self.assertEqual(md.render_many(['*a*', '*' * 11]), ['<p><em>a</em></p>\n',
+                                                          '<pre>' + '*' * 11 + '</pre>\n'])
+
+    def test_nesting(self):
+        text = '> ' * 6 + 'deep'
+        self.assertIn('deep', Misaka().render(text))
+        md = Misaka(max_nesting=3)
+        self.assertEqual(md.render(text).count('<blockquote>'), 4)
+        self.assertNotIn('deep', md.render(text))
+        self.assertNotIn('deep', md.render(text, smartypants=True, toc=True))
+        self.assertNotEqual(md.fingerprint(), Misaka().fingerprint())
+
+    def test_timeout(self):
+        md = Misaka(renderer=SlowRenderer, render_timeout=0.3, on_limit='escape', toc=True)
+        self.assertEqual(md.render('fast').strip(), '<p>fast</p>')
+        self.assertEqual(md.render('slow'), '<pre>slow</pre>\n')
+        result = md.render('# Title')
+        self.assertEqual(result.headings, [Heading(1, 'Title', 'title')])
+        md = Misaka(renderer=SlowRenderer, render_timeout=0.3)
+        self.assertRaises(RenderLimitExceeded, md.render, 'slow')
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Misaka, on_limit='ignore')
+        self.assertRaises(ValueError, Misaka, renderer=misaka.HtmlRenderer(), render_timeout=1)
+
+
+class ConstantBlockTests(TestCase):
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.md = Misaka(self.app, smartypants=True)
+
+    def render(self, source, **context):
+        with self.app.app_context():
+            return render_template_string(source, **context)
+
+    def test_constant_block(self):
+        source = '<div>{% filter markdown %}\n"Static" *text*\n{% endfilter %}</div>'
+        template = self.app.jinja_env.from_string(source)
+        with mock.patch.object(self.md, 'render') as render:
+            self.assertEqual(template.render(),
+                             '<div><p>&ldquo;Static&rdquo; <em>text</em></p>\n</div>')
+        self.assertFalse(render.called)
+
+    def test_dynamic_block(self):
+        self.assertEqual(self.render('{% filter markdown %}*{{ a }}* {% if b %}b{% endif %}'
+                                     '{% endfilter %}', a='<a>', b=True),
+                         '<p><em>&lt;a&gt;</em> b</p>\n')
+        with mock.patch("flask_misaka.misaka.smartypants", side_effect=misaka.smartypants) as sp, \
+                mock.patch("flask_misaka._lib", None):
+            self.render('{% filter markdown %}*{{ a }}*{% endfilter %}', a=1)
+        self.assertTrue(sp.called)
+
+    def test_other_filter(self):
+        app = Flask(__name__)
+        app.jinja_env.filters['markdown'] = lambda text: text.upper()
+        Misaka(app)
+        with app.app_context():
+            self.assertEqual(render_template_string('{% filter markdown %}*a*{% endfilter %}'),
+                             '*A*')
+
+
+class FragmentCacheTests(TestCase):
+    source = '{% markdown key="post-" ~ id, ttl=60 %}*{{ body() }}*{% endmarkdown %}'
+
+    def setUp(self):
+        self.app = Flask(__name__)
+        self.cache = RenderCache()
+        self.md = Misaka(self.app, cache=self.cache)
+        self.body = mock.Mock(return_value='Hello')
+
+    def render(self, source, **context):
+        with self.app.app_context():
+            return render_template_string(source, body=self.body, **context)
+
+    def test_cached(self):
+        self.assertEqual(self.render(self.source, id=1), '<p><em>Hello</em></p>\n')
+        with mock.patch("flask_misaka.misaka.html") as html:
+            self.assertEqual(self.render(self.source, id=1), '<p><em>Hello</em></p>\n')
+        self.assertFalse(html.called)
+        self.assertEqual(self.body.call_count, 1)
+        self.render(self.source, id=2)
+        self.assertEqual(self.body.call_count, 2)
+
+    def test_ttl(self):
+        with mock.patch.object(self.cache, 'set', wraps=self.cache.set) as cache_set:
+            self.render(self.source, id=1)
+        self.assertEqual(cache_set.call_args[0][2], 60)
+
+    def test_options(self):
+        source = '{% markdown key="k", smartypants=True %}"{{ body() }}"{% endmarkdown %}'
+        self.assertEqual(self.render(source), '<p>&ldquo;Hello&rdquo;</p>\n')
+        # the options are part of the key
+        source = '{% markdown key="k" %}"{{ body() }}"{% endmarkdown %}'
+        self.assertEqual(self.render(source), '<p>&quot;Hello&quot;</p>\n')
+
+    def test_without_key(self):
+        source = '{% markdown %}*{{ body() }}*{% endmarkdown %}'
+        self.render(source)
+        self.assertEqual(self.render(source), '<p><em>Hello</em></p>\n')
+        self.assertEqual(self.body.call_count, 2)
+
+    def test_async_template(self):
+        import asyncio
+        from jinja2 import Environment
+        env = Environment(enable_async=True, autoescape=True)
+        Misaka(mock.Mock(jinja_env=env), cache=self.cache, async_threshold=0)
+        template = env.from_string(self.source)
+        for _ in range(2):
+            self.assertEqual(asyncio.run(template.render_async(body=self.body, id=1)),
+                             '<p><em>Hello</em></p>\n')
+        self.assertEqual(self.body.call_count, 1)
+
+
+class SanitizeTests(TestCase):
+    def render(self, text, **options):
+        return markdown(text, sanitize=True, **options)
+
+    def test_inline_html(self):
+        self.assertEqual(self.render('a <b onclick="x()" title=\'t"\'>b</b> <script>x</script>'),
+                         '<p>a <b title="t&quot;">b</b> &lt;script&gt;x&lt;/script&gt;</p>\n')
+        self.assertEqual(self.render('<!-- secret --> <i>open\n\nnext</i>'),
+                         '<p><i>open</i></p>\n<p>next&lt;/i&gt;</p>\n')
+
+    def test_block_html(self):
+        self.assertEqual(self.render('<div class="x">\n<style>p {}</style>\n'
+                                     '<p>a & b</p><br/><span>\n</div>\n\n<!-- c -->\n'),
+                         '<div>\n&lt;style&gt;p {}&lt;/style&gt;\n<p>a &amp; b</p><br>'
+                         '<span>\n</span></div>\n\n')
+
+    def test_urls(self):
+        self.assertEqual(self.render('<a href=" java&#x73;cript:x()">a</a> [b](javascript:x) '
+                                     '![c](data:x) <img src="vbscript:y" alt="d">'),
+                         '<p><a>a</a> b c <img alt="d"></p>\n')
+        self.assertEqual(self.render('<javascript:x()> <http://x.com/?a=1&b> <foo@example.com>'),
+                         '<p>javascript:x() <a href="http://x.com/?a=1&amp;b">http://x.com/?a=1&amp;b</a>'
+                         ' <a href="mailto:foo@example.com">foo@example.com</a></p>\n')
+        self.assertEqual(self.render('[a](/x "T") ![b](https://x.com/b.png)', xhtml=True),
+                         '<p><a href="/x" title="T">a</a> '
+                         '<img src="https://x.com/b.png" alt="b"/></p>\n')
+
+    def test_same_html(self):
+        text = dedent("""
+            # Title
+
+            Some *text*,
+            a [link](http://example.com "Title") and `code`.
+
+            | a | b |
+            |---|---|
+            | 1 | 2 |
+
+            > quoted
+            > text
+
+            - one
+            - two
+        """)
+        for options in ({}, {'tables': True, 'wrap': True}, {'xhtml': True, 'wrap': True}):
+            # Python callbacks can't separate blocks with newlines like Hoedown does
+            self.assertEqual(self.render(text, **options).replace('\n\n', '\n'),
+                             markdown(text, **options).replace('\n\n', '\n'))
+
+    def test_blocks_close_tags(self):
+        self.assertEqual(self.render('# <a href="http://x">title\n\nafter'),
+                         '<h1><a href="http://x">title</a></h1>\n<p>after</p>\n')
+        self.assertEqual(self.render('- item <b>x\n- item2\n\nafter'),
+                         '<ul>\n<li>item <b>x</b></li>\n<li>item2</li>\n</ul>\n<p>after</p>\n')
+        self.assertEqual(self.render('| <b>a | b |\n|:--|--:|\n| 1 | 2 |\n', tables=True),
+                         markdown('| <b>a</b> | b |\n|:--|--:|\n| 1 | 2 |\n', tables=True))
+        renderer = flask_misaka._make_renderer(None, make_profile(sanitize=True))
+        renderer.reset()
+        renderer.raw_html('<em>')
+        self.assertEqual(renderer.blockquote('<p>x</p>\n'),
+                         '<blockquote>\n<p>x</p>\n</em></blockquote>\n')
+
+    def test_elements(self):
+        md = Misaka(elements={'header': {'class': 'title'}}, sanitize=True)
+        self.assertEqual(md.render('# <i>title'), '<h1 class="title"><i>title</i></h1>\n')
+
+    def test_allowlists(self):
+        class Sanitizer(flask_misaka.SanitizeFeature):
+            allowed_tags = frozenset(['a'])
+            allowed_schemes = frozenset(['https'])
+
+        with mock.patch.dict(flask_misaka.FEATURES, sanitize=Sanitizer):
+            flask_misaka._feature_classes.clear()
+            try:
+                self.assertEqual(self.render('<b>[a](http://x) <a href="https://x">b</a>'),
+                                 '<p>&lt;b&gt;a <a href="https://x">b</a></p>\n')
+            finally:
+                flask_misaka._feature_classes.clear()
+
+
+class ElementRendererTests(TestCase):
+    doc = dedent("""
+        # Title
+
+        A [link](/x "T") and <http://example.com>.
+
+        ---
+
+        | a |
+        |---|
+        | 1 |
+    """)
+
+    def test_attributes(self):
+        md = Misaka(elements={'table': {'class': 'table'}, 'link': {'rel': 'nofollow'},
+                              'autolink': {'rel': 'nofollow'}}, tables=True, autolink=True)
+        result = md.render(self.doc)
+        self.assertIn('<table class="table">\n<thead>', result)
+        self.assertIn('<a href="/x" title="T" rel="nofollow">link</a>', result)
+        self.assertIn('<a href="http://example.com" rel="nofollow">http://example.com</a>', result)
+        self.assertIn('<h1>Title</h1>', result)
+
+    def test_templates(self):
+        md = Misaka(elements={'header': '<h{level} class="x">{content}</h{level}>\n',
+                              'hrule': '<hr class="{{sep}}">\n',
+                              'link': '<a href="{href}">{content} ({title})</a>'})
+        result = md.render(self.doc + '\n[<b>](/a?b&c "<T>")')
+        self.assertIn('<h1 class="x">Title</h1>', result)
+        self.assertIn('<hr class="{sep}">', result)
+        self.assertIn('<a href="/a?b&amp;c"><b> (&lt;T&gt;)</a>', result)
+
+    def test_same_html(self):
+        renderer = element_renderer(dict((name, {}) for name in flask_misaka.ELEMENTS))
+        text = self.doc + dedent("""
+            Some *text*, `code` and ![img](/i.png "I").
+
+            > quote
+
+            1. one
+            2. two
+
+            ```python
+            x = 1
+            ```
+        """)
+        for options in ({}, {'tables': True, 'fenced_code': True, 'wrap': True},
+                        {'xhtml': True, 'autolink': True}):
+            self.assertEqual(
+                Misaka(renderer=renderer, **options).render(text).replace('\n\n', '\n'),
+                markdown(text, **options).replace('\n\n', '\n'))
+
+    def test_native_elements(self):
+        renderer = element_renderer({'table': {'class': 't'}})
+        self.assertFalse(hasattr(renderer, 'paragraph'))
+        self.assertFalse(hasattr(renderer, 'link'))
+
+    def test_fingerprint(self):
+        first = Misaka(elements={'table': {'class': 'a'}})
+        self.assertEqual(first.fingerprint(), Misaka(elements={'table': {'class': 'a'}}).fingerprint())
+        self.assertNotEqual(first.fingerprint(), Misaka(elements={'table': {'class': 'b'}}).fingerprint())
+
+    def test_render_timeout(self):
+        md = Misaka(elements={'table': {'class': 'table'}}, tables=True, render_timeout=5)
+        self.assertEqual(md.render(self.doc),
+                         Misaka(elements={'table': {'class': 'table'}}, tables=True).render(self.doc))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, element_renderer, {'blink': {}})
+        self.assertRaises(ValueError, Misaka, renderer=misaka.HtmlRenderer(),
+                          elements={'table': {}})
+
+
+class StubEngine(flask_misaka.Engine):
+    options = {'tables': 'tables', 'hard_wrap': None, 'wrap': None}
+
+    def __init__(self):
+        self.render = mock.Mock(side_effect=lambda text, profile: '<p>"%s"</p>\n' % text)
+
+
+class EngineTests(TestCase):
+    def setUp(self):
+        self.engine = StubEngine()
+        patcher = mock.patch.dict(flask_misaka.ENGINES, stub=self.engine)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_engine(self):
+        self.assertEqual(markdown('text', engine='stub', tables=True), '<p>"text"</p>\n')
+        profile = self.engine.render.call_args[0][1]
+        self.assertEqual(profile.engine, 'stub')
+        self.assertEqual(self.engine.features(profile), ['tables'])
+        self.assertEqual(markdown('text', engine='stub', smartypants=True),
+                         '<p>&ldquo;text&rdquo;</p>\n')
+
+    def test_misaka(self):
+        md = Misaka(engine='stub')
+        self.assertEqual(md.render('text'), '<p>"text"</p>\n')
+        self.assertEqual(md.render('*text*', engine='misaka'), '<p><em>text</em></p>\n')
+        self.assertNotEqual(md.fingerprint(), md.fingerprint(engine='misaka'))
+        self.assertEqual(md.render_many(['a', 'b']), ['<p>"a"</p>\n', '<p>"b"</p>\n'])
+
+    def test_unsupported(self):
+        self.assertEqual(self.engine.unsupported(make_profile(tables=True, wrap=True,
+                                                              no_intra_emphasis=True)),
+                         ['no_intra_emphasis'])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            markdown('text', engine='stub', autolink=True)
+        self.assertIn('autolink', str(caught[0].message))
+        self.assertRaises(ValueError, markdown, 'text', engine='stub', toc=True)
+        self.assertRaises(ValueError, Misaka, renderer=misaka.HtmlRenderer, engine='stub')
+        self.assertRaises(ValueError, markdown, 'text', engine='nope')
+
+    def test_preference(self):
+        engines = ['stub', 'misaka']
+        self.assertEqual(make_profile(engine=engines, tables=True).engine, 'stub')
+        self.assertEqual(make_profile(engine=engines, autolink=True).engine, 'misaka')
+        self.assertEqual(make_profile(engine=engines, toc=True).engine, 'misaka')
+        self.assertEqual(Misaka(engine=engines).render('text'), '<p>"text"</p>\n')
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter('always')
+            self.assertEqual(make_profile(engine=['stub'], autolink=True).engine, 'stub')
+        self.engine.available = mock.Mock(return_value=False)
+        self.assertEqual(make_profile(engine=engines, tables=True).engine, 'misaka')
+        self.assertRaises(ValueError, make_profile, engine=['stub'])
+        self.assertRaises(ValueError, make_profile, engine=['nope', 'misaka'])
+
+    def test_misaka_engine(self):
+        profile = make_profile(tables=True)
+        self.assertEqual(flask_misaka.ENGINES['misaka'].render(TEST_MD, profile),
+                         markdown(TEST_MD, tables=True))
+        self.assertEqual(flask_misaka.ENGINES['misaka'].unsupported(
+            make_profile(**dict((name, True) for name in flask_misaka.OPTIONS
+                                if name not in flask_misaka.FEATURES and name != 'engine'))), [])
+
+    def test_installed_engines(self):
+        for name, engine in flask_misaka.ENGINES.items():
+            if name == 'stub' or not engine.available():
+                continue
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                html = markdown('| a | b |\n|---|---|\n| 1 | 2 |\n\n*text*',
+                                engine=name, tables=True)
+            self.assertIn('<table>', html)
+            self.assertIn('<em>text</em>', html)